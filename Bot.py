@@ -1,119 +1,1623 @@
 import telebot
 from telebot import types
 import requests
+from requests.adapters import HTTPAdapter
 import io
 import threading
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import concurrent.futures
 import sqlite3
 import hashlib
+import tempfile
+import shutil
+import queue
+import math
+import functools
+import heapq
+import itertools
+import time
+import json
+import argparse
+import os
+import socket
+import zlib
+import abc
+import multiprocessing
+import bisect
+import contextlib
+import logging
+import logging.handlers
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
 from datetime import datetime
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # Без Pillow перцептивные хеши фотографий не вычисляются
+
 bot = None
 API_TOKEN = None
 TARGET_CHAT_ID = None
 db_connection = None
 
+# Адрес сервера Bot API (можно указать локальный сервер, например для тестов)
+TELEGRAM_API_URL = 'https://api.telegram.org'
+
 # Глобальная таблица для хранения медиа-альбомов
 media_groups = defaultdict(list)
 media_groups_lock = threading.Lock()
-media_groups_timers = {}
 media_groups_downloading = defaultdict(int)  # Счетчик загружающихся файлов для каждой группы
+media_groups_ready = set()  # Группы, у которых истекло ожидание новых медиа, но еще идут загрузки
+media_groups_started = {}  # Время получения первого медиа группы, для метрики ожидания альбома
+
+# Альбом отправляется через MEDIA_GROUP_DEBOUNCE секунд после последнего полученного медиа
+# (или сразу после завершения последней загрузки, если она закончилась позже)
+MEDIA_GROUP_DEBOUNCE = 1.0
 
 # Глобальная таблица для хранения сообщений с порядком по message_id для каждой media_group_id
 media_groups_by_msgid = defaultdict(list)
 
+# Ключи медиа, которые сейчас дедуплицируются и отправляются (ключ -> Event завершения)
+inflight_media_keys = {}
+inflight_media_lock = threading.Lock()
+
+# Границы числа одновременных загрузок, фактический предел подстраивается под задержку и ошибки
+DOWNLOAD_MIN_WORKERS = 2
+DOWNLOAD_MAX_WORKERS = 16
+DOWNLOAD_TARGET_LATENCY = 1.5  # Целевое время до получения заголовков ответа, в секундах
+SEND_WORKERS = 4
+
 # Пул потоков для загрузки файлов
-download_executor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
+download_executor = concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_MAX_WORKERS)
+
+# Пул потоков для отправки альбомов, задачи в него ставит планировщик
+send_executor = concurrent.futures.ThreadPoolExecutor(max_workers=SEND_WORKERS)
+
+# Общая сессия с пулом keep-alive соединений для загрузок и для запросов к Bot API
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=DOWNLOAD_MAX_WORKERS + SEND_WORKERS + 4)
+http_session.mount('https://', http_adapter)
+http_session.mount('http://', http_adapter)
+telebot.apihelper.session = http_session
+
+# ==================== Журнал и метрики ====================
+
+# Логгер бота: записи кладутся в очередь, а выводит их отдельный поток (QueueListener),
+# поэтому вызовы логгера на горячих путях не ждут ввода-вывода
+logger = logging.getLogger('tgbot')
+log_queue = queue.SimpleQueue()
+log_listener = None
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(threadName)s] %(message)s'
+
+# Границы корзин гистограмм длительности стадий, в секундах
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def setup_logging(level=logging.INFO):
+    """Направляет журнал бота в stderr через очередь и поток QueueListener"""
+    global log_listener
+    if log_listener is not None:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    log_listener.start()
+
+def stop_logging():
+    """Выводит оставшиеся в очереди записи журнала и останавливает поток вывода"""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+class MetricsRegistry:
+    """
+    Счетчики и гистограммы в памяти процесса, выдаются в текстовом формате Prometheus
+    Метки передаются кортежем пар (имя, значение); обновление - несколько операций под одной блокировкой
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.descriptions = {}  # имя -> (тип, описание)
+        self.counters = defaultdict(float)  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [количество в каждой корзине..., сумма, количество]
+
+    def describe(self, name, kind, description):
+        self.descriptions[name] = (kind, description)
+
+    def inc(self, name, value=1, labels=()):
+        with self.lock:
+            self.counters[(name, labels)] += value
+
+    def observe(self, name, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = [0] * (len(self.buckets) + 1) + [0.0, 0]
+                self.histograms[(name, labels)] = histogram
+            histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def render(self, gauges=()):
+        """Возвращает все метрики в текстовом формате Prometheus, gauges - список (имя, значение)"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+
+        lines = []
+        described = set()
+
+        def header(name, default_kind):
+            if name not in described:
+                described.add(name)
+                kind, description = self.descriptions.get(name, (default_kind, name))
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f"{name}{format_metric_labels(labels)} {value:g}")
+        for (name, labels), histogram in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), histogram):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{format_metric_labels(labels)} {histogram[-2]:.6f}")
+            lines.append(f"{name}_count{format_metric_labels(labels)} {histogram[-1]}")
+        for name, value in gauges:
+            header(name, 'gauge')
+            lines.append(f"{name} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+def format_metric_labels(labels):
+    """Форматирует метки метрики: {stage="download"}"""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+metrics = MetricsRegistry(METRICS_BUCKETS)
+metrics.describe('tgbot_stage_duration_seconds', 'histogram', "Длительность стадии обработки медиа")
+metrics.describe('tgbot_stage_total', 'counter', "Количество выполнений стадии по результату")
+metrics.describe('tgbot_stage_bytes_total', 'counter', "Байт, полученных на стадии")
+metrics.describe('tgbot_db_rows_total', 'counter', "Строк, переданных на запись в БД")
+metrics.describe('tgbot_send_retries_total', 'counter', "Повторы отправки в чат по причине")
+metrics.describe('tgbot_duplicates_total', 'counter', "Найденные дубликаты по способу обнаружения")
+
+def observe_stage(stage, seconds, error=False):
+    """Учитывает одно выполнение стадии обработки"""
+    labels = (('stage', stage),)
+    metrics.observe('tgbot_stage_duration_seconds', seconds, labels)
+    metrics.inc('tgbot_stage_total', 1, labels + (('outcome', 'error' if error else 'ok'),))
+
+@contextlib.contextmanager
+def measure_stage(stage):
+    """Измеряет длительность блока кода как стадию stage, исключение считается ошибкой стадии"""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        observe_stage(stage, time.perf_counter() - started, error=True)
+        raise
+    observe_stage(stage, time.perf_counter() - started)
+
+def timed_stage(stage):
+    """Декоратор: каждый вызов функции учитывается как выполнение стадии stage"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure_stage(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Ограничитель числа одновременных загрузок (AIMD)
+    Предел растет на единицу за окно успешных быстрых загрузок и уменьшается,
+    если сглаженная задержка выше целевой или загрузка завершилась ошибкой
+    """
+    def __init__(self, min_limit, max_limit, target_latency):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.limit = float(min_limit)
+        self.in_flight = 0
+        self.latency = None  # Сглаженная задержка (EWMA)
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, error=False):
+        with self.condition:
+            self.in_flight -= 1
+            if error:
+                self.limit = max(self.min_limit, self.limit / 2)
+            elif latency is not None:
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                if self.latency > self.target_latency:
+                    self.limit = max(self.min_limit, self.limit * 0.9)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+download_limiter = AdaptiveConcurrencyLimiter(DOWNLOAD_MIN_WORKERS, DOWNLOAD_MAX_WORKERS, DOWNLOAD_TARGET_LATENCY)
+
+class DeadlineScheduler:
+    """
+    Планировщик отложенных задач на одном потоке с кучей дедлайнов
+    Задачи идентифицируются ключом, повторное планирование по тому же ключу
+    переносит дедлайн. Сработавшие задачи выполняются в пуле потоков
+    """
+    def __init__(self, executor):
+        self.executor = executor
+        self.heap = []  # [(deadline, seq, key)]
+        self.tasks = {}  # key -> (seq, callback, args)
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def schedule(self, key, delay, callback, *args):
+        """Планирует callback(*args) через delay секунд, заменяя предыдущую задачу с тем же ключом"""
+        with self.condition:
+            seq = next(self.counter)
+            self.tasks[key] = (seq, callback, args)
+            heapq.heappush(self.heap, (time.monotonic() + delay, seq, key))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="deadline-scheduler", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def cancel(self, key):
+        """Отменяет задачу с указанным ключом"""
+        with self.condition:
+            self.tasks.pop(key, None)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while True:
+                    # Пропускаем устаревшие записи кучи (задача отменена или перенесена)
+                    while self.heap and self.tasks.get(self.heap[0][2], (None,))[0] != self.heap[0][1]:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    timeout = self.heap[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+                _, _, key = heapq.heappop(self.heap)
+                _, callback, args = self.tasks.pop(key)
+            self.executor.submit(callback, *args)
+
+scheduler = DeadlineScheduler(send_executor)
+
+# Настройки потоковой загрузки
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Размер куска при чтении ответа
+DOWNLOAD_SPOOL_THRESHOLD = 8 * 1024 * 1024  # Файлы крупнее этого порога сбрасываются из памяти во временный файл
+
+class DownloadedMedia(tempfile.SpooledTemporaryFile):
+    """
+    Скачанный медиафайл. Небольшие файлы хранятся в памяти, крупные - во временном файле на диске.
+    Хранит SHA256 хеш и размер, посчитанные во время загрузки, чтобы не перечитывать данные
+    """
+    def __init__(self, max_size=DOWNLOAD_SPOOL_THRESHOLD):
+        super().__init__(max_size=max_size)
+        self.data_hash = None
+        self.size = 0
+        self.phash = None
+        self.prefix_hash = None
+        self.reserved_bytes = 0  # Сколько байт бюджета памяти занято этим файлом
+
+# Двухуровневый отпечаток крупных файлов: сначала размер и SHA256 первых PREFIX_FINGERPRINT_BYTES байт
+# (запрос Range), полный файл скачивается, только если в БД есть медиа с таким же отпечатком начала
+PREFIX_FINGERPRINT_BYTES = 64 * 1024
+PREFIX_MIN_FILE_SIZE = 1024 * 1024  # Файлы меньше этого размера сразу скачиваются целиком
+
+class MediaFingerprint:
+    """
+    Отпечаток медиа без содержимого: размер и хеш начала файла, для медиа, скачанного
+    до перезапуска (см. WorkJournal.load_media), также полный и перцептивный хеши
+    Содержимого нет, поэтому такое медиа всегда отправляется по file_id
+    """
+    def __init__(self, size, prefix_hash, data_hash=None, phash=None):
+        self.size = size
+        self.prefix_hash = prefix_hash
+        self.data_hash = data_hash
+        self.phash = phash
+        self.reserved_bytes = 0
+
+# Общий бюджет памяти для скачиваемых и ожидающих отправки файлов. Учитывается часть файла,
+# которая может находиться в памяти (не больше DOWNLOAD_SPOOL_THRESHOLD), остальное уходит на диск
+MEMORY_BUDGET_BYTES = 256 * 1024 * 1024
+
+class MemoryBudget:
+    """Счетчик занятой памяти с жестким лимитом"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.rejected = 0  # Сколько загрузок не поместилось в бюджет
+        self.lock = threading.Lock()
+
+    def try_reserve(self, size):
+        """Резервирует size байт, если они помещаются в лимит"""
+        with self.lock:
+            if self.used + size > self.limit:
+                self.rejected += 1
+                return False
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, size):
+        with self.lock:
+            self.used = max(0, self.used - size)
+
+memory_budget = MemoryBudget(MEMORY_BUDGET_BYTES)
+
+# Политика пересылки медиа
+RESEND_BY_FILE_ID = True  # Отправлять по исходному file_id, скачанные данные нужны только для дедупликации
+HASH_SKIP_MEDIA_TYPES = set()  # Типы медиа, которые не скачиваются и не хешируются (например, {'audio', 'document'})
+HASH_MAX_FILE_SIZE = None  # Файлы крупнее этого размера (в байтах) не скачиваются и не хешируются
+
+# ==================== Кеш дедупликации в памяти ====================
+
+# Настройки кеша file_unique_id перед SQLite
+DEDUP_CACHE_SIZE = 100000  # Максимальное количество записей в LRU-кеше
+USE_BLOOM_FILTER = True  # Отсекать заведомо новые file_unique_id без запроса к БД
+BLOOM_FILTER_CAPACITY = 1000000  # Ожидаемое количество ключей в фильтре
+BLOOM_FILTER_ERROR_RATE = 0.01  # Допустимая доля ложноположительных ответов
+
+class LRUCache:
+    """Потокобезопасный LRU-кеш ограниченного размера"""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+    def discard(self, key, value):
+        """Удаляет ключ, если он все еще связан с value"""
+        with self.lock:
+            if self.items.get(key) == value:
+                del self.items[key]
+
+    def most_recent(self, count):
+        """Возвращает до count последних использованных пар (ключ, значение), от старых к новым"""
+        with self.lock:
+            return list(itertools.islice(reversed(self.items.items()), count))[::-1]
+
+    def __len__(self):
+        return len(self.items)
+
+class BloomFilter:
+    """
+    Фильтр Блума для строковых ключей
+    Отрицательный ответ гарантирует, что ключ никогда не добавлялся
+    """
+    def __init__(self, capacity, error_rate):
+        self.bit_count = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.bit_count / capacity * math.log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.lock = threading.Lock()
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bit_count for i in range(self.hash_count)]
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self.lock:
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+unique_id_cache = LRUCache(DEDUP_CACHE_SIZE)
+unique_id_bloom = None
+
+# Настройки поиска похожих фотографий по перцептивному хешу (64-битный dHash)
+PHASH_ENABLED = True
+PHASH_MAX_DISTANCE = 6  # Максимальное расстояние Хэмминга, при котором фото считаются одинаковыми
+PHASH_SEGMENTS = 4  # Количество сегментов индекса (изменение требует перестроения media_phash_segments)
 
 # ==================== Функции для работы с базой данных ====================
 
-def init_database():
-    """Инициализирует базу данных для хранения информации о медиа-файлах"""
-    global db_connection
-    db_connection = sqlite3.connect('media_deduplication.db', check_same_thread=False)
-    cursor = db_connection.cursor()
+# Настройки базы данных: чтение идет через отдельные соединения каждого потока,
+# запись - через одну очередь, которую пачками разбирает поток-писатель
+DATABASE_PATH = 'media_deduplication.db'
+DB_WRITE_BATCH_SIZE = 500  # Максимальное количество записей в одной транзакции
+
+db_local = threading.local()  # Соединения для чтения, по одному на поток
+db_write_queue = queue.Queue()
+db_writer_thread = None
+
+# Записи, поставленные в очередь, но еще не записанные в БД (file_id -> строка media_files)
+pending_media = {}
+pending_media_lock = threading.Lock()
+
+def open_database_connection(check_same_thread=True):
+    """Открывает соединение с базой данных в режиме WAL"""
+    connection = sqlite3.connect(DATABASE_PATH, check_same_thread=check_same_thread)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+def get_read_connection():
+    """Возвращает соединение для чтения текущего потока"""
+    connection = getattr(db_local, 'connection', None)
+    if connection is None:
+        connection = open_database_connection()
+        db_local.connection = connection
+    return connection
 
-    # Создаем таблицу для хранения информации о медиа
+SCHEMA_VERSION = 3  # Версия схемы, хранится в PRAGMA user_version
+
+# Настройки хранения: записи старше RETENTION_DAYS переносятся в архивную БД,
+# разбитую на таблицы по месяцам (или удаляются, если ARCHIVE_DATABASE_PATH = None)
+RETENTION_DAYS = None  # None - хранить все записи
+ARCHIVE_DATABASE_PATH = 'media_deduplication_archive.db'
+RETENTION_CHECK_INTERVAL = 24 * 60 * 60  # Период запуска задачи очистки, в секундах
+RETENTION_BATCH_SIZE = 10000  # Количество записей, переносимых за одну транзакцию
+
+def create_schema(cursor):
+    """
+    Создает таблицы текущей версии схемы
+    media_files - полная запись о медиа, ключ file_id
+    media_hashes и media_unique_ids - компактные таблицы для поиска дубликатов,
+    ключом служит сам искомый столбец, поэтому отдельные индексы не нужны
+    """
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS media_files (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            file_id TEXT NOT NULL UNIQUE,
+            file_id TEXT PRIMARY KEY,
             message_id INTEGER NOT NULL,
-            data_hash TEXT,
+            file_unique_id TEXT,
+            data_hash BLOB,
             file_size INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
+            phash INTEGER,
+            created_at INTEGER NOT NULL,
+            prefix_hash BLOB
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_hashes (
+            data_hash BLOB PRIMARY KEY,
+            file_size INTEGER,
+            message_id INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_unique_ids (
+            file_unique_id TEXT PRIMARY KEY,
+            message_id INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    # Отпечатки начала крупных файлов; пустой prefix_hash - файл, записанный до появления отпечатков,
+    # для него известен только размер
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_prefixes (
+            file_size INTEGER NOT NULL,
+            prefix_hash BLOB NOT NULL,
+            file_id TEXT NOT NULL,
+            PRIMARY KEY (file_size, prefix_hash, file_id)
+        ) WITHOUT ROWID
+    ''')
+    # Индекс перцептивных хешей: хеш разбит на сегменты, каждый сегмент ищется по точному значению
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_phash_segments (
+            segment INTEGER NOT NULL,
+            value INTEGER NOT NULL,
+            phash INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            PRIMARY KEY (segment, value, phash, message_id)
+        ) WITHOUT ROWID
+    ''')
+    # Резервы ключей медиа, которые сейчас отправляет один из процессов (см. SQLiteDedupStore.try_claim)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_claims (
+            claim_key TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+def migrate_from_v1(cursor):
+    """
+    Переносит данные из исходной таблицы media_files (AUTOINCREMENT, хеш в hex-строке)
+    в компактную схему версии 2
+    """
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(media_files)')]
+    unique_id_column = 'file_unique_id' if 'file_unique_id' in columns else 'NULL'
+    phash_column = 'phash' if 'phash' in columns else 'NULL'
+
+    cursor.execute('ALTER TABLE media_files RENAME TO media_files_v1')
+    cursor.execute('DROP INDEX IF EXISTS idx_file_id')
+    cursor.execute('DROP INDEX IF EXISTS idx_hash_size')
+    cursor.execute('DROP INDEX IF EXISTS idx_file_unique_id')
+    create_schema(cursor)
+
+    cursor.execute(f'''
+        INSERT OR IGNORE INTO media_files (file_id, message_id, file_unique_id, data_hash, file_size, phash, created_at)
+        SELECT file_id, message_id, {unique_id_column}, hex_to_blob(data_hash), file_size, {phash_column},
+               COALESCE(CAST(strftime('%s', created_at) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER))
+        FROM media_files_v1 ORDER BY id
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO media_hashes (data_hash, file_size, message_id)
+        SELECT data_hash, file_size, message_id FROM media_files WHERE data_hash IS NOT NULL ORDER BY created_at
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO media_unique_ids (file_unique_id, message_id)
+        SELECT file_unique_id, message_id FROM media_files WHERE file_unique_id IS NOT NULL ORDER BY created_at
     ''')
+    cursor.execute('DROP TABLE media_files_v1')
+    add_legacy_prefixes(cursor)
+
+def migrate_from_v2(cursor):
+    """Добавляет отпечатки начала файлов (схема версии 3)"""
+    cursor.execute('ALTER TABLE media_files ADD COLUMN prefix_hash BLOB')
+    create_schema(cursor)
+    add_legacy_prefixes(cursor)
+
+def add_legacy_prefixes(cursor):
+    """
+    Заносит в media_prefixes крупные файлы, записанные без отпечатка начала, с пустым отпечатком,
+    чтобы новые файлы того же размера скачивались целиком и сверялись по полному хешу
+    """
+    cursor.execute('''
+        INSERT OR IGNORE INTO media_prefixes (file_size, prefix_hash, file_id)
+        SELECT file_size, x'', file_id FROM media_files
+        WHERE prefix_hash IS NULL AND data_hash IS NOT NULL AND file_size >= ?
+    ''', (PREFIX_MIN_FILE_SIZE,))
+
+def init_database(shared=False):
+    """
+    Инициализирует базу данных для хранения информации о медиа-файлах
+    shared - в тот же файл пишут другие процессы (см. warm_dedup_cache)
+    """
+    global db_connection, db_writer_thread
+    db_connection = open_database_connection(check_same_thread=False)
+    db_connection.create_function('hex_to_blob', 1, lambda value: bytes.fromhex(value) if value else None)
+    cursor = db_connection.cursor()
+
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
+    has_tables = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'media_files'").fetchone()
+    if not has_tables:
+        # Новая база: освобожденные страницы можно будет возвращать через incremental_vacuum
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+    migrated = False
+    cursor.execute('BEGIN')
+    try:
+        if has_tables and version < 2:
+            migrate_from_v1(cursor)
+            migrated = True
+        elif has_tables and version < 3:
+            migrate_from_v2(cursor)
+        create_schema(cursor)
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        db_connection.commit()
+    except Exception:
+        db_connection.rollback()
+        raise
+
+    if migrated:
+        # Применяем auto_vacuum к перенесенной базе и возвращаем место старых таблиц
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+        logger.info("База данных перенесена на схему версии %s", SCHEMA_VERSION)
+    logger.info("База данных инициализирована")
+
+    warm_dedup_cache(shared)
+
+    db_writer_thread = threading.Thread(target=database_writer, name="database-writer", daemon=True)
+    db_writer_thread.start()
+
+    if RETENTION_DAYS is not None:
+        schedule_media_retention(delay=0)
+
+def close_database():
+    """Дожидается записи всех поставленных в очередь данных и закрывает соединение"""
+    if db_writer_thread is not None:
+        db_write_queue.put(None)
+        db_writer_thread.join()
+    if db_connection:
+        db_connection.close()
+        logger.info("Соединение с базой данных закрыто")
+
+def database_writer():
+    """
+    Поток-писатель: забирает записи из очереди и сохраняет их пачками
+    Все, что накопилось в очереди за время предыдущей транзакции, пишется одним commit
+    Вызываемые объекты в очереди - служебные задачи, которые выполняются на этом же потоке
+    """
+    stopping = False
+    while not stopping:
+        row = db_write_queue.get()
+        if row is None:
+            break
+        batch = []
+        task = None
+        while True:
+            if callable(row):
+                task = row
+                break
+            batch.append(row)
+            if len(batch) >= DB_WRITE_BATCH_SIZE:
+                break
+            try:
+                row = db_write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if row is None:
+                stopping = True
+                break
+        if batch:
+            write_media_batch(batch)
+        if task is not None:
+            try:
+                task()
+            except Exception as e:
+                logger.error("Ошибка служебной задачи БД: %s", e)
+
+def write_media_batch(rows):
+    """
+    Записывает пачку медиа во все таблицы поиска в одной транзакции
+    Возвращает False, если пачка не записана (транзакция откачена)
+    """
+    started = time.perf_counter()
+    error = False
+    try:
+        now = int(time.time())
+        cursor = db_connection.cursor()
+        # Полный хеш уже записанного файла может быть досчитан позже (см. resolve_prefix_candidates)
+        cursor.executemany('''
+            INSERT INTO media_files (file_id, message_id, file_unique_id, data_hash, file_size, phash, created_at, prefix_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (file_id) DO UPDATE SET data_hash = COALESCE(media_files.data_hash, excluded.data_hash)
+        ''', [(file_id, message_id, file_unique_id, data_hash, file_size,
+               to_signed64(phash) if phash is not None else None, now, prefix_hash)
+              for file_id, message_id, data_hash, file_size, file_unique_id, phash, prefix_hash in rows])
+        inserted = cursor.rowcount
+        cursor.executemany('INSERT OR IGNORE INTO media_hashes (data_hash, file_size, message_id) VALUES (?, ?, ?)',
+                           [(data_hash, file_size, message_id)
+                            for _, message_id, data_hash, file_size, _, _, _ in rows if data_hash])
+        cursor.executemany('INSERT OR IGNORE INTO media_unique_ids (file_unique_id, message_id) VALUES (?, ?)',
+                           [(file_unique_id, message_id)
+                            for _, message_id, _, _, file_unique_id, _, _ in rows if file_unique_id])
+        cursor.executemany('INSERT OR IGNORE INTO media_prefixes (file_size, prefix_hash, file_id) VALUES (?, ?, ?)',
+                           [(file_size, prefix_hash, file_id)
+                            for file_id, _, _, file_size, _, _, prefix_hash in rows if prefix_hash and file_size])
+        cursor.executemany('INSERT OR IGNORE INTO media_phash_segments (segment, value, phash, message_id) VALUES (?, ?, ?, ?)',
+                           [(segment, value, to_signed64(phash), message_id)
+                            for _, message_id, _, _, _, phash, _ in rows if phash is not None
+                            for segment, value in enumerate(split_phash(phash))])
+        db_connection.commit()
+        logger.debug("Записано в БД медиа: %s из %s", inserted, len(rows))
+    except Exception as e:
+        db_connection.rollback()
+        error = True
+        logger.error("Ошибка записи пачки медиа в БД: %s", e)
+    finally:
+        observe_stage('db_insert', time.perf_counter() - started, error=error)
+        metrics.inc('tgbot_db_rows_total', len(rows))
+        with pending_media_lock:
+            for row in rows:
+                if pending_media.get(row[0]) is row:
+                    del pending_media[row[0]]
+    return not error
+
+def schedule_media_retention(delay=RETENTION_CHECK_INTERVAL):
+    """Планирует задачу очистки; сама очистка выполняется на потоке-писателе"""
+    scheduler.schedule(('media_retention',), delay, db_write_queue.put, run_media_retention)
+
+def run_media_retention():
+    """
+    Переносит записи старше RETENTION_DAYS в архивную БД (таблица на каждый месяц)
+    и удаляет их из таблиц поиска, затем возвращает освободившиеся страницы
+    Так рабочий набор основной БД остается небольшим и помещается в кеш страниц
+    """
+    try:
+        cutoff = int(time.time()) - RETENTION_DAYS * 24 * 60 * 60
+        cursor = db_connection.cursor()
+        if ARCHIVE_DATABASE_PATH:
+            cursor.execute('ATTACH DATABASE ? AS archive', (ARCHIVE_DATABASE_PATH,))
+        total = 0
+        try:
+            while True:
+                rows = cursor.execute('''
+                    SELECT file_id, message_id, file_unique_id, data_hash, file_size, phash, created_at, prefix_hash
+                    FROM media_files WHERE created_at < ? LIMIT ?
+                ''', (cutoff, RETENTION_BATCH_SIZE)).fetchall()
+                if not rows:
+                    break
+
+                if ARCHIVE_DATABASE_PATH:
+                    partitions = defaultdict(list)
+                    for row in rows:
+                        partitions[time.strftime('%Y%m', time.gmtime(row[6]))].append(row[:7])
+                    for partition, partition_rows in partitions.items():
+                        cursor.execute(f'''
+                            CREATE TABLE IF NOT EXISTS archive.media_files_{partition} (
+                                file_id TEXT PRIMARY KEY,
+                                message_id INTEGER NOT NULL,
+                                file_unique_id TEXT,
+                                data_hash BLOB,
+                                file_size INTEGER,
+                                phash INTEGER,
+                                created_at INTEGER NOT NULL
+                            ) WITHOUT ROWID
+                        ''')
+                        cursor.executemany(f'''
+                            INSERT OR IGNORE INTO archive.media_files_{partition}
+                            (file_id, message_id, file_unique_id, data_hash, file_size, phash, created_at)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)
+                        ''', partition_rows)
+
+                cursor.executemany('DELETE FROM media_files WHERE file_id = ?', [(row[0],) for row in rows])
+                cursor.executemany('DELETE FROM media_hashes WHERE data_hash = ? AND message_id = ?',
+                                   [(row[3], row[1]) for row in rows if row[3]])
+                cursor.executemany('DELETE FROM media_unique_ids WHERE file_unique_id = ? AND message_id = ?',
+                                   [(row[2], row[1]) for row in rows if row[2]])
+                cursor.executemany('DELETE FROM media_prefixes WHERE file_size = ? AND file_id = ?',
+                                   [(row[4], row[0]) for row in rows if row[4] is not None])
+                cursor.executemany('DELETE FROM media_phash_segments WHERE segment = ? AND value = ? AND phash = ? AND message_id = ?',
+                                   [(segment, value, row[5], row[1]) for row in rows if row[5] is not None
+                                    for segment, value in enumerate(split_phash(row[5] & 0xFFFFFFFFFFFFFFFF))])
+                db_connection.commit()
+                # Перенесенное в архив медиа больше не считается дубликатом и в кеше оставаться не должно.
+                # Фильтр Блума не перестраивается: его ложные срабатывания лишь приводят к запросу в БД
+                for row in rows:
+                    if row[2]:
+                        unique_id_cache.discard(row[2], row[1])
+                total += len(rows)
+        finally:
+            if ARCHIVE_DATABASE_PATH:
+                cursor.execute('DETACH DATABASE archive')
+
+        if total:
+            cursor.execute('PRAGMA incremental_vacuum')
+            cursor.execute('PRAGMA optimize')
+            logger.info("Очистка БД: перенесено в архив %s записей старше %s дней", total, RETENTION_DAYS)
+    except Exception as e:
+        db_connection.rollback()
+        logger.error("Ошибка очистки БД: %s", e)
+    finally:
+        schedule_media_retention()
 
-    # Создаем индексы для быстрого поиска
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_file_id ON media_files(file_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_hash_size ON media_files(data_hash, file_size)')
+def warm_dedup_cache(shared=False):
+    """
+    Заполняет кеш file_unique_id из базы данных при запуске
+    В фильтр Блума попадают все ключи, в LRU-кеш - самые свежие
+    Если в базу пишут и другие процессы (shared), фильтр не строится: их записи в него
+    не попадут, и промах фильтра перестанет означать, что ключа нет в базе
+    """
+    global unique_id_bloom
+    unique_id_bloom = None
+    if USE_BLOOM_FILTER and not shared:
+        unique_id_bloom = BloomFilter(BLOOM_FILTER_CAPACITY, BLOOM_FILTER_ERROR_RATE)
+
+    cursor = db_connection.cursor()
+    cursor.execute('SELECT file_unique_id, message_id FROM media_files WHERE file_unique_id IS NOT NULL ORDER BY created_at')
+    count = 0
+    for file_unique_id, message_id in cursor:
+        if unique_id_bloom is not None:
+            unique_id_bloom.add(file_unique_id)
+        unique_id_cache.put(file_unique_id, message_id)
+        count += 1
+    logger.info("Кеш дедупликации прогрет: %s ключей, в LRU-кеше: %s", count, len(unique_id_cache))
+
+def find_pending_media(predicate):
+    """Ищет среди еще не записанных в БД медиа строку, подходящую под predicate"""
+    with pending_media_lock:
+        for row in pending_media.values():
+            if predicate(row):
+                return row
+    return None
+
+@timed_stage('db_lookup')
+def find_media_by_unique_ids(file_unique_ids):
+    """
+    Ищет медиа по списку file_unique_id одним запросом
+    Сначала смотрит в LRU-кеш и фильтр Блума, в БД запрашиваются только оставшиеся ключи
+    Возвращает словарь file_unique_id -> message_id для найденных
+    """
+    found = {}
+    missing = []
+    for file_unique_id in set(filter(None, file_unique_ids)):
+        message_id = unique_id_cache.get(file_unique_id)
+        if message_id is not None:
+            found[file_unique_id] = message_id
+        elif unique_id_bloom is None or file_unique_id in unique_id_bloom:
+            missing.append(file_unique_id)
 
-    db_connection.commit()
-    print("База данных инициализирована")
+    if missing:
+        placeholders = ','.join('?' * len(missing))
+        cursor = get_read_connection().execute(
+            f'SELECT file_unique_id, message_id FROM media_unique_ids WHERE file_unique_id IN ({placeholders})', missing)
+        for file_unique_id, message_id in cursor:
+            unique_id_cache.put(file_unique_id, message_id)
+            found[file_unique_id] = message_id
+    return found
+
+@timed_stage('db_lookup')
+def find_media_by_file_ids(file_ids):
+    """
+    Ищет медиа по списку file_id одним запросом
+    Возвращает словарь file_id -> message_id для найденных
+    """
+    file_ids = list(set(filter(None, file_ids)))
+    found = {}
+    with pending_media_lock:
+        for file_id in file_ids:
+            if file_id in pending_media:
+                found[file_id] = pending_media[file_id][1]
+
+    missing = [file_id for file_id in file_ids if file_id not in found]
+    if missing:
+        placeholders = ','.join('?' * len(missing))
+        cursor = get_read_connection().execute(
+            f'SELECT file_id, message_id FROM media_files WHERE file_id IN ({placeholders})', missing)
+        found.update(cursor.fetchall())
+    return found
+
+@timed_stage('db_lookup')
+def find_media_by_hashes(hash_sizes):
+    """
+    Ищет медиа по списку пар (хеш, размер) одним запросом
+    Возвращает словарь (хеш, размер) -> message_id для найденных
+    """
+    hash_sizes = [(data_hash, file_size) for data_hash, file_size in set(hash_sizes) if data_hash]
+    found = {}
+    for data_hash, file_size in hash_sizes:
+        row = find_pending_media(lambda row: row[2] == data_hash and (file_size is None or row[3] == file_size))
+        if row is not None:
+            found[(data_hash, file_size)] = row[1]
+
+    missing = {data_hash for data_hash, file_size in hash_sizes if (data_hash, file_size) not in found}
+    if missing:
+        placeholders = ','.join('?' * len(missing))
+        cursor = get_read_connection().execute(
+            f'SELECT data_hash, file_size, message_id FROM media_hashes WHERE data_hash IN ({placeholders})', list(missing))
+        for data_hash, stored_size, message_id in cursor:
+            for key in ((data_hash, stored_size), (data_hash, None)):
+                if key in hash_sizes and key not in found:
+                    found[key] = message_id
+    return found
+
+def check_media_by_unique_id(file_unique_id):
+    """
+    Проверяет, существует ли медиа с таким file_unique_id, не обращаясь к сети
+    Сначала смотрит в LRU-кеш и фильтр Блума, затем в базу данных
+    Возвращает message_id если найдено, иначе None
+    """
+    return dedup_store.find_by_unique_ids([file_unique_id]).get(file_unique_id)
 
 def check_media_by_file_id(file_id):
     """
     Проверяет, существует ли медиа с таким file_id в базе данных
     Возвращает message_id если найдено, иначе None
     """
-    cursor = db_connection.cursor()
-    cursor.execute('SELECT message_id FROM media_files WHERE file_id = ?', (file_id,))
-    result = cursor.fetchone()
-    return result[0] if result else None
+    return dedup_store.find_by_file_ids([file_id]).get(file_id)
+
+def check_media_by_ids(message, file_id):
+    """
+    Проверяет медиа сообщения по file_unique_id и file_id, не обращаясь к сети
+    Возвращает message_id если найдено, иначе None
+    """
+    existing_message_id = check_media_by_unique_id(get_file_unique_id(message))
+    if existing_message_id is None:
+        existing_message_id = check_media_by_file_id(file_id)
+    return existing_message_id
 
 def check_media_by_hash(data_hash, file_size):
     """
     Проверяет, существует ли медиа с таким хешем и размером в базе данных
     Возвращает message_id если найдено, иначе None
     """
-    if not data_hash:
+    return dedup_store.find_by_hashes([(data_hash, file_size)]).get((data_hash, file_size))
+
+def split_phash(phash):
+    """Разбивает 64-битный перцептивный хеш на PHASH_SEGMENTS сегментов"""
+    bits = 64 // PHASH_SEGMENTS
+    mask = (1 << bits) - 1
+    return [(phash >> (i * bits)) & mask for i in range(PHASH_SEGMENTS)]
+
+@functools.lru_cache(maxsize=None)
+def phash_segment_masks(bits, radius):
+    """Возвращает все маски длины bits, в которых установлено не более radius битов"""
+    masks = [0]
+    for _ in range(radius):
+        masks = sorted(set(masks) | {mask | (1 << i) for mask in masks for i in range(bits)})
+    return masks
+
+def to_signed64(value):
+    """Переводит беззнаковое 64-битное число в знаковое для хранения в SQLite"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def phash_distance(first, second):
+    """Расстояние Хэмминга между двумя перцептивными хешами"""
+    return bin((first ^ second) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+def check_media_by_phash(phash):
+    """
+    Проверяет, есть ли в хранилище фото, похожее на фото с перцептивным хешем phash
+    Возвращает message_id если найдено, иначе None
+    """
+    if phash is None:
         return None
+    return dedup_store.find_by_phash(phash)
+
+@timed_stage('db_lookup')
+def find_media_by_phash(phash):
+    """
+    Ищет фото с перцептивным хешем на расстоянии Хэмминга не больше PHASH_MAX_DISTANCE
+    Использует многоиндексное хеширование: если хеши отличаются не более чем на d битов,
+    то хотя бы один из m сегментов отличается не более чем на d // m битов,
+    поэтому достаточно проверить небольшую окрестность каждого сегмента по индексу
+    Возвращает message_id ближайшего найденного фото, иначе None
+    """
+    if phash is None:
+        return None
+
+    pending = find_pending_media(lambda row: row[5] is not None and phash_distance(row[5], phash) <= PHASH_MAX_DISTANCE)
+    if pending:
+        return pending[1]
+
+    bits = 64 // PHASH_SEGMENTS
+    masks = phash_segment_masks(bits, PHASH_MAX_DISTANCE // PHASH_SEGMENTS)
+    best = None
+    cursor = get_read_connection().cursor()
+    for segment, value in enumerate(split_phash(phash)):
+        values = [value ^ mask for mask in masks]
+        placeholders = ','.join('?' * len(values))
+        cursor.execute(f'SELECT phash, message_id FROM media_phash_segments WHERE segment = ? AND value IN ({placeholders})',
+                       (segment, *values))
+        for candidate, message_id in cursor.fetchall():
+            distance = phash_distance(candidate, phash)
+            if distance <= PHASH_MAX_DISTANCE and (best is None or distance < best[0]):
+                best = (distance, message_id)
+    return best[1] if best else None
+
+@timed_stage('db_lookup')
+def find_prefix_candidates(file_size, prefix_hash):
+    """
+    Ищет медиа того же размера с тем же отпечатком начала файла (или записанные без отпечатка)
+    Возвращает список (file_id, message_id, data_hash)
+    """
+    candidates = []
+    with pending_media_lock:
+        for row in pending_media.values():
+            if row[3] == file_size and row[6] == prefix_hash:
+                candidates.append((row[0], row[1], row[2]))
+
+    cursor = get_read_connection().execute('''
+        SELECT f.file_id, f.message_id, f.data_hash
+        FROM media_prefixes p JOIN media_files f ON f.file_id = p.file_id
+        WHERE p.file_size = ? AND p.prefix_hash IN (?, x'')
+    ''', (file_size, prefix_hash))
+    candidates.extend(cursor.fetchall())
+    return candidates
+
+def add_media_to_database(file_id, message_id, data_hash=None, file_size=None, file_unique_id=None, phash=None,
+                          prefix_hash=None):
+    """Добавляет информацию о медиа-файле в хранилище дедупликации"""
+    row = (file_id, message_id, data_hash, file_size, file_unique_id, phash, prefix_hash)
+    dedup_store.add_media(row)
+    if journal is not None:
+        journal.record_sent(row)
+
+def queue_media_row(row):
+    """
+    Ставит запись о медиа в очередь потока-писателя локальной БД
+    До записи медиа видно через pending_media и кеш
+    Если медиа с тем же file_id уже ожидает записи, новая запись принимается, только если
+    дополняет его полным хешем (см. resolve_prefix_candidates)
+    """
+    file_id, message_id, data_hash, file_size, file_unique_id, _, _ = row
+    with pending_media_lock:
+        pending_row = pending_media.get(file_id)
+        if pending_row is not None:
+            if data_hash is None or pending_row[2] is not None:
+                logger.debug("Медиа с file_id=%s уже ожидает записи в БД", file_id)
+                return
+            row = tuple(value if value is not None else new_value for value, new_value in zip(pending_row, row))
+            file_id, message_id, data_hash, file_size, file_unique_id, _, _ = row
+        pending_media[file_id] = row
+    if file_unique_id:
+        unique_id_cache.put(file_unique_id, message_id)
+        if unique_id_bloom is not None:
+            unique_id_bloom.add(file_unique_id)
+    db_write_queue.put(row)
+    logger.debug("Медиа добавлено в БД: file_id=%s, message_id=%s, hash=%s, size=%s",
+                 file_id, message_id, data_hash.hex() if data_hash else None, file_size)
+
+# ==================== Хранилище дедупликации ====================
+
+# Несколько процессов (или машин) с ботом делят одно хранилище. Перед проверкой и отправкой медиа
+# процесс резервирует его ключи (file_unique_id, хеш) на CLAIM_TTL секунд; если процесс упал,
+# не сняв резерв, медиа сможет обработать другой процесс после истечения срока
+CLAIM_TTL = 120
+CLAIM_RENEW_INTERVAL = CLAIM_TTL / 4  # Период продления удерживаемых резервов, в секундах
+CLAIM_POLL_INTERVAL = 0.2  # Период повторной попытки зарезервировать занятые ключи, в секундах
+DEDUP_STORE_TIMEOUT = 10  # Таймаут запроса к сетевому хранилищу, в секундах
+PROCESS_ID = f"{socket.gethostname()}:{os.getpid()}"  # Владелец резервов этого процесса
+
+class DedupStore(abc.ABC):
+    """
+    Интерфейс хранилища дедупликации: поиск уже отправленных медиа, запись новых
+    и межпроцессные резервы ключей медиа
+    Резерв снимается только после того, как записанные до него медиа видны другим процессам,
+    поэтому процесс, дождавшийся резерва, найдет медиа как дубликат и не отправит его повторно
+    """
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def find_by_unique_ids(self, file_unique_ids):
+        """Возвращает словарь file_unique_id -> message_id для найденных"""
+
+    @abc.abstractmethod
+    def find_by_file_ids(self, file_ids):
+        """Возвращает словарь file_id -> message_id для найденных"""
+
+    @abc.abstractmethod
+    def find_by_hashes(self, hash_sizes):
+        """Возвращает словарь (хеш, размер) -> message_id для найденных"""
+
+    @abc.abstractmethod
+    def find_by_phash(self, phash):
+        """Возвращает message_id похожего фото или None"""
+
+    @abc.abstractmethod
+    def find_prefix_candidates(self, file_size, prefix_hash):
+        """Возвращает список (file_id, message_id, data_hash) медиа с тем же отпечатком начала"""
+
+    @abc.abstractmethod
+    def add_media(self, row):
+        """Записывает медиа, row - строка media_files (как в pending_media)"""
+
+    @abc.abstractmethod
+    def try_claim(self, keys, owner, ttl):
+        """Резервирует все ключи разом; возвращает False, если часть из них занята другим владельцем"""
+
+    @abc.abstractmethod
+    def release(self, keys, owner):
+        """Снимает резервы владельца"""
+
+class SQLiteDedupStore(DedupStore):
+    """
+    Хранилище в локальном файле SQLite
+    Файл можно разделить между процессами одной машины (shared=True): резервы тогда хранятся
+    в media_claims, а фильтр Блума не используется. Единственному процессу резервы нужны,
+    только если он обслуживает другие процессы (dedup_server.py, claims=True)
+    """
+    def __init__(self, claims=False, shared=False):
+        self.claims = claims or shared
+        self.shared = shared
+
+    def open(self):
+        init_database(self.shared)
+
+    def close(self):
+        close_database()
+
+    def find_by_unique_ids(self, file_unique_ids):
+        return find_media_by_unique_ids(file_unique_ids)
+
+    def find_by_file_ids(self, file_ids):
+        return find_media_by_file_ids(file_ids)
+
+    def find_by_hashes(self, hash_sizes):
+        return find_media_by_hashes(hash_sizes)
+
+    def find_by_phash(self, phash):
+        return find_media_by_phash(phash)
+
+    def find_prefix_candidates(self, file_size, prefix_hash):
+        return find_prefix_candidates(file_size, prefix_hash)
+
+    def add_media(self, row):
+        queue_media_row(row)
+
+    def try_claim(self, keys, owner, ttl):
+        if not self.claims or not keys:
+            return True
+        keys = list(keys)
+        placeholders = ','.join('?' * len(keys))
+        now = time.time()
+        connection = get_read_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            busy = connection.execute(
+                f'SELECT 1 FROM media_claims WHERE claim_key IN ({placeholders}) AND owner != ? AND expires_at > ? LIMIT 1',
+                (*keys, owner, now)).fetchone()
+            if not busy:
+                connection.executemany('INSERT OR REPLACE INTO media_claims (claim_key, owner, expires_at) VALUES (?, ?, ?)',
+                                       [(key, owner, now + ttl) for key in keys])
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        return not busy
+
+    def release(self, keys, owner):
+        if not self.claims or not keys:
+            return
+        keys = list(keys)
+
+        def release_claims():
+            placeholders = ','.join('?' * len(keys))
+            db_connection.execute(f'DELETE FROM media_claims WHERE claim_key IN ({placeholders}) AND owner = ?',
+                                  (*keys, owner))
+            db_connection.commit()
+
+        # Задача выполняется потоком-писателем после записи всех поставленных ранее медиа
+        db_write_queue.put(release_claims)
+
+def encode_media_row(row):
+    """Переводит строку медиа в JSON-совместимый вид для сетевого хранилища"""
+    file_id, message_id, data_hash, file_size, file_unique_id, phash, prefix_hash = row
+    return [file_id, message_id, data_hash.hex() if data_hash else None, file_size, file_unique_id, phash,
+            prefix_hash.hex() if prefix_hash is not None else None]
+
+def decode_media_row(values):
+    """Обратное преобразование для encode_media_row"""
+    file_id, message_id, data_hash, file_size, file_unique_id, phash, prefix_hash = values
+    return (file_id, message_id, bytes.fromhex(data_hash) if data_hash else None, file_size, file_unique_id, phash,
+            bytes.fromhex(prefix_hash) if prefix_hash is not None else None)
+
+class RemoteDedupStore(DedupStore):
+    """
+    Клиент сетевого хранилища (dedup_server.py): каждый метод - POST с JSON на адрес url/<метод>
+    Найденные file_unique_id кешируются локально, остальные запросы идут на сервер
+    """
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def call(self, method, payload):
+        with measure_stage('dedup_store'):
+            response = http_session.post(f"{self.url}/{method}", json=payload, timeout=DEDUP_STORE_TIMEOUT)
+            response.raise_for_status()
+            return response.json()['result']
+
+    def open(self):
+        self.call('ping', {})
+        logger.info("Используется сетевое хранилище дедупликации %s", self.url)
+
+    def find_by_unique_ids(self, file_unique_ids):
+        found = {}
+        missing = []
+        for file_unique_id in set(filter(None, file_unique_ids)):
+            message_id = unique_id_cache.get(file_unique_id)
+            if message_id is not None:
+                found[file_unique_id] = message_id
+            else:
+                missing.append(file_unique_id)
+        if missing:
+            for file_unique_id, message_id in self.call('find_by_unique_ids', {'keys': missing}).items():
+                unique_id_cache.put(file_unique_id, message_id)
+                found[file_unique_id] = message_id
+        return found
+
+    def find_by_file_ids(self, file_ids):
+        file_ids = list(set(filter(None, file_ids)))
+        return self.call('find_by_file_ids', {'keys': file_ids}) if file_ids else {}
+
+    def find_by_hashes(self, hash_sizes):
+        items = [[data_hash.hex(), file_size] for data_hash, file_size in set(hash_sizes) if data_hash]
+        if not items:
+            return {}
+        return {(bytes.fromhex(data_hash), file_size): message_id
+                for data_hash, file_size, message_id in self.call('find_by_hashes', {'items': items})}
+
+    def find_by_phash(self, phash):
+        return self.call('find_by_phash', {'phash': phash})
+
+    def find_prefix_candidates(self, file_size, prefix_hash):
+        return [(file_id, message_id, bytes.fromhex(data_hash) if data_hash else None)
+                for file_id, message_id, data_hash in self.call('find_prefix_candidates',
+                                                                {'file_size': file_size, 'prefix_hash': prefix_hash.hex()})]
+
+    def add_media(self, row):
+        self.call('add_media', {'row': encode_media_row(row)})
+        if row[4]:
+            unique_id_cache.put(row[4], row[1])
+
+    def try_claim(self, keys, owner, ttl):
+        if not keys:
+            return True
+        return self.call('try_claim', {'keys': list(keys), 'owner': owner, 'ttl': ttl})
+
+    def release(self, keys, owner):
+        if keys:
+            self.call('release', {'keys': list(keys), 'owner': owner})
+
+def create_dedup_store(url=None, shared=False):
+    """
+    Создает хранилище: сетевое, если указан url, иначе локальную БД SQLite
+    shared - локальную БД используют несколько процессов-обработчиков
+    """
+    if url:
+        return RemoteDedupStore(url)
+    return SQLiteDedupStore(shared=shared)
+
+dedup_store = SQLiteDedupStore()
+
+# ==================== Журнал незавершенной работы ====================
+
+# Журнал на диске хранит работу, которая еще не завершена: принятые обновления с медиа, скачанные
+# файлы с посчитанными хешами и отправленные медиа. При запуске бот дописывает в хранилище
+# отправленные медиа и заново обрабатывает оставшиеся обновления, не скачивая и не хешируя
+# уже скачанные файлы. Медиа, отправленное, но не успевшее попасть в журнал, будет отправлено повторно
+JOURNAL_PATH = 'media_journal.db'  # None - журнал отключен
+JOURNAL_MAX_AGE = 24 * 60 * 60  # Более старые записи при запуске отбрасываются, в секундах
+JOURNAL_HOT_KEYS = 10000  # Сколько последних использованных file_unique_id сохранять для прогрева кеша
+JOURNAL_HOT_KEYS_INTERVAL = 60  # Период сохранения горячих ключей, в секундах
+JOURNAL_HOT_KEYS_CHECK_BATCH = 500  # Сколько горячих ключей проверять в хранилище одним запросом
+
+class WorkJournal:
+    """
+    Журнал незавершенной работы в отдельном файле SQLite
+    Содержимое скачанных файлов хранится в папке рядом с журналом под именем хеша
+    Записи сообщения удаляются, когда оно обработано полностью
+    """
+    def __init__(self, path):
+        self.path = path
+        self.blob_dir = os.path.splitext(path)[0] + '_blobs'
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        # synchronous=NORMAL в режиме WAL сохраняет записи при падении процесса
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS journal_updates (
+                update_id INTEGER PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                media_group_id TEXT,
+                file_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                received_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_journal_updates_message ON journal_updates(chat_id, message_id);
+            CREATE INDEX IF NOT EXISTS idx_journal_updates_group ON journal_updates(media_group_id);
+            CREATE TABLE IF NOT EXISTS journal_media (
+                file_id TEXT PRIMARY KEY,
+                blob_path TEXT,
+                data_hash BLOB,
+                file_size INTEGER,
+                phash INTEGER,
+                prefix_hash BLOB,
+                recorded_at REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS journal_sent (
+                file_id TEXT PRIMARY KEY,
+                row TEXT NOT NULL,
+                sent_at REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS journal_hot_keys (
+                position INTEGER PRIMARY KEY,
+                file_unique_id TEXT NOT NULL,
+                message_id INTEGER NOT NULL
+            );
+        ''')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def record_update(self, update):
+        """
+        Записывает принятое обновление с медиа
+        Возвращает False, если обновление уже есть в журнале (повторная доставка)
+        """
+        message = update.message
+        file_id = get_file_id(message) if message is not None else None
+        if file_id is None:
+            return True
+        payload = json.dumps({'update_id': update.update_id, 'message': message.json})
+        with self.lock:
+            cursor = self.connection.execute(
+                'INSERT OR IGNORE INTO journal_updates (update_id, chat_id, message_id, media_group_id, file_id, '
+                'payload, received_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (update.update_id, message.chat.id, message.message_id, message.media_group_id, file_id, payload,
+                 time.time()))
+            self.connection.commit()
+        return cursor.rowcount > 0
+
+    def discard_update(self, update_id):
+        """Удаляет обновление, которое так и не было принято в обработку"""
+        with self.lock:
+            self.connection.execute('DELETE FROM journal_updates WHERE update_id = ?', (update_id,))
+            self.connection.commit()
+
+    def record_media(self, file_id, file_data):
+        """
+        Записывает хеши скачанного медиа
+        Содержимое сохраняется рядом с журналом, только если медиа отправляется загрузкой данных
+        (RESEND_BY_FILE_ID выключен): при отправке по file_id после перезапуска хватает хешей
+        """
+        blob_path = None
+        if isinstance(file_data, DownloadedMedia) and not RESEND_BY_FILE_ID:
+            blob_path = os.path.join(self.blob_dir, file_data.data_hash.hex())
+            if not os.path.exists(blob_path):
+                temp_path = f"{blob_path}.{threading.get_ident()}.tmp"
+                with open(temp_path, 'wb') as f:
+                    shutil.copyfileobj(file_data, f)
+                os.replace(temp_path, blob_path)
+                file_data.seek(0)
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO journal_media (file_id, blob_path, data_hash, file_size, phash, prefix_hash, '
+                'recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (file_id, blob_path, file_data.data_hash, file_data.size,
+                 to_signed64(file_data.phash) if file_data.phash is not None else None, file_data.prefix_hash,
+                 time.time()))
+            self.connection.commit()
+
+    def load_media(self, file_id):
+        """
+        Восстанавливает скачанное ранее медиа без повторной загрузки и хеширования
+        Возвращает DownloadedMedia (или MediaFingerprint), либо None, если медиа нет в журнале
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT blob_path, data_hash, file_size, phash, prefix_hash FROM journal_media WHERE file_id = ?',
+                (file_id,)).fetchone()
+        if row is None:
+            return None
+        blob_path, data_hash, file_size, phash, prefix_hash = row
+        phash = phash & 0xFFFFFFFFFFFFFFFF if phash is not None else None
+        if blob_path is None:
+            return MediaFingerprint(file_size, prefix_hash, data_hash, phash)
+        file_data = DownloadedMedia()
+        try:
+            with open(blob_path, 'rb') as f:
+                shutil.copyfileobj(f, file_data)
+        except FileNotFoundError:
+            file_data.close()
+            return None
+        file_data.seek(0)
+        file_data.data_hash = data_hash
+        file_data.size = file_size
+        file_data.phash = phash
+        file_data.prefix_hash = prefix_hash
+        return file_data
+
+    def record_sent(self, row):
+        """Записывает отправленное медиа (строку media_files), чтобы после падения дописать его в хранилище"""
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO journal_sent (file_id, row, sent_at) VALUES (?, ?, ?)',
+                                    (row[0], json.dumps(encode_media_row(row)), time.time()))
+            self.connection.commit()
+
+    def finish(self, condition, params):
+        """Удаляет обновления, подходящие под condition, вместе с их медиа и файлами содержимого"""
+        with self.lock:
+            file_ids = [file_id for file_id, in self.connection.execute(
+                f'SELECT file_id FROM journal_updates WHERE {condition}', params)]
+            if not file_ids:
+                return
+            placeholders = ','.join('?' * len(file_ids))
+            blob_paths = {blob_path for blob_path, in self.connection.execute(
+                f'SELECT blob_path FROM journal_media WHERE file_id IN ({placeholders}) AND blob_path IS NOT NULL',
+                file_ids)}
+            self.connection.execute(f'DELETE FROM journal_updates WHERE {condition}', params)
+            self.connection.execute(f'DELETE FROM journal_media WHERE file_id IN ({placeholders})', file_ids)
+            self.connection.execute(f'DELETE FROM journal_sent WHERE file_id IN ({placeholders})', file_ids)
+            self.connection.commit()
+            # Одинаковое содержимое разных сообщений хранится в одном файле
+            for blob_path in blob_paths:
+                if not self.connection.execute('SELECT 1 FROM journal_media WHERE blob_path = ? LIMIT 1',
+                                               (blob_path,)).fetchone():
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(blob_path)
+
+    def finish_message(self, message):
+        self.finish('chat_id = ? AND message_id = ?', (message.chat.id, message.message_id))
+
+    def finish_media_group(self, media_group_id):
+        self.finish('media_group_id = ?', (media_group_id,))
+
+    def drop_expired(self, max_age):
+        """Удаляет записи старше max_age секунд и файлы содержимого, на которые не ссылается журнал"""
+        cutoff = time.time() - max_age
+        with self.lock:
+            self.connection.execute('DELETE FROM journal_updates WHERE received_at < ?', (cutoff,))
+            self.connection.execute('DELETE FROM journal_media WHERE recorded_at < ?', (cutoff,))
+            self.connection.execute('DELETE FROM journal_sent WHERE sent_at < ?', (cutoff,))
+            self.connection.commit()
+            used = {blob_path for blob_path, in self.connection.execute(
+                'SELECT blob_path FROM journal_media WHERE blob_path IS NOT NULL')}
+            for name in os.listdir(self.blob_dir):
+                blob_path = os.path.join(self.blob_dir, name)
+                if blob_path not in used:
+                    os.remove(blob_path)
+
+    def sent_rows(self):
+        """Возвращает отправленные медиа как строки media_files"""
+        with self.lock:
+            return [decode_media_row(json.loads(row)) for row, in self.connection.execute('SELECT row FROM journal_sent')]
+
+    def pending_updates(self):
+        """Возвращает незавершенные обновления в порядке поступления: (update_id, media_group_id, file_id, payload)"""
+        with self.lock:
+            return self.connection.execute(
+                'SELECT update_id, media_group_id, file_id, payload FROM journal_updates ORDER BY update_id').fetchall()
+
+    def save_hot_keys(self, items):
+        """Сохраняет последние использованные file_unique_id (от старых к новым)"""
+        with self.lock:
+            self.connection.execute('DELETE FROM journal_hot_keys')
+            self.connection.executemany('INSERT INTO journal_hot_keys (position, file_unique_id, message_id) VALUES (?, ?, ?)',
+                                        [(position, key, message_id) for position, (key, message_id) in enumerate(items)])
+            self.connection.commit()
+
+    def load_hot_keys(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT file_unique_id, message_id FROM journal_hot_keys ORDER BY position').fetchall()
+
+journal = None
+
+def open_journal(path):
+    """
+    Открывает журнал и продолжает работу, прерванную прошлым запуском
+    Вызывается после запуска обработчиков обновлений: восстановленные обновления ставятся в их очередь
+    """
+    global journal
+    journal = WorkJournal(path)
+    journal.drop_expired(JOURNAL_MAX_AGE)
+
+    # Отправленные медиа могли не успеть попасть в хранилище, их сообщения обрабатывать заново не нужно
+    sent_rows = journal.sent_rows()
+    for row in sent_rows:
+        dedup_store.add_media(row)
+
+    # Горячие ключи прошлого запуска поднимаются в начало LRU-кеша. Ключи сверяются с хранилищем:
+    # медиа могло быть с тех пор перенесено в архив (см. run_media_retention)
+    hot_keys = journal.load_hot_keys()
+    stored = {}
+    for start in range(0, len(hot_keys), JOURNAL_HOT_KEYS_CHECK_BATCH):
+        batch = hot_keys[start:start + JOURNAL_HOT_KEYS_CHECK_BATCH]
+        stored.update(dedup_store.find_by_unique_ids([file_unique_id for file_unique_id, _ in batch]))
+    hot_keys = [(file_unique_id, message_id) for file_unique_id, message_id in hot_keys
+                if stored.get(file_unique_id) == message_id]
+    for file_unique_id, message_id in hot_keys:
+        unique_id_cache.put(file_unique_id, message_id)
+    sent_file_ids = {row[0] for row in sent_rows}
+    for _, media_group_id, file_id, payload in journal.pending_updates():
+        if file_id in sent_file_ids:
+            if media_group_id:
+                journal.finish_media_group(media_group_id)
+            else:
+                journal.finish_message(types.Update.de_json(payload).message)
 
-    cursor = db_connection.cursor()
-    if file_size is not None:
-        cursor.execute('SELECT message_id FROM media_files WHERE data_hash = ? AND file_size = ?',
-                      (data_hash, file_size))
-    else:
-        cursor.execute('SELECT message_id FROM media_files WHERE data_hash = ?', (data_hash,))
+    pending = journal.pending_updates()
+    for _, _, _, payload in pending:
+        update_queue.put((time.perf_counter(), types.Update.de_json(payload)))
+    logger.info("Журнал %s: дописано отправленных медиа: %s, повторно обрабатывается обновлений: %s, "
+                "горячих ключей: %s", path, len(sent_rows), len(pending), len(hot_keys))
+    scheduler.schedule(('journal_hot_keys',), JOURNAL_HOT_KEYS_INTERVAL, save_journal_hot_keys)
 
-    result = cursor.fetchone()
-    return result[0] if result else None
+def save_journal_hot_keys(reschedule=True):
+    """Сохраняет горячие ключи кеша дедупликации в журнал"""
+    if journal is None:
+        return
+    try:
+        journal.save_hot_keys(unique_id_cache.most_recent(JOURNAL_HOT_KEYS))
+    except Exception as e:
+        logger.error("Не удалось сохранить горячие ключи в журнал: %s", e)
+    if reschedule:
+        scheduler.schedule(('journal_hot_keys',), JOURNAL_HOT_KEYS_INTERVAL, save_journal_hot_keys)
 
-def add_media_to_database(file_id, message_id, data_hash=None, file_size=None):
-    """
-    Добавляет информацию о медиа-файле в базу данных
-    """
+def close_journal():
+    """Сохраняет горячие ключи и закрывает журнал; незавершенная работа останется до следующего запуска"""
+    global journal
+    if journal is None:
+        return
+    scheduler.cancel(('journal_hot_keys',))
+    save_journal_hot_keys(reschedule=False)
+    closing, journal = journal, None
+    closing.close()
+
+def finish_journaled_messages(messages):
+    """Удаляет из журнала полностью обработанные одиночные сообщения"""
+    if journal is None:
+        return
+    for message in messages:
+        try:
+            journal.finish_message(message)
+        except Exception as e:
+            logger.error("Ошибка журнала при завершении сообщения %s: %s", message.message_id, e)
+
+def finish_journaled_media_group(media_group_id):
+    """Удаляет из журнала полностью обработанный альбом"""
+    if journal is None:
+        return
     try:
-        cursor = db_connection.cursor()
-        cursor.execute('''
-            INSERT INTO media_files (file_id, message_id, data_hash, file_size)
-            VALUES (?, ?, ?, ?)
-        ''', (file_id, message_id, data_hash, file_size))
-        db_connection.commit()
-        print(f"Медиа добавлено в БД: file_id={file_id}, message_id={message_id}, hash={data_hash}, size={file_size}")
-    except sqlite3.IntegrityError:
-        print(f"Медиа с file_id={file_id} уже существует в БД")
+        journal.finish_media_group(media_group_id)
     except Exception as e:
-        print(f"Ошибка добавления медиа в БД: {e}")
+        logger.error("Ошибка журнала при завершении группы %s: %s", media_group_id, e)
 
 def calculate_file_hash(file_data):
     """
-    Вычисляет SHA256 хеш файла из BytesIO объекта
+    Вычисляет SHA256 хеш (32 байта) файла из BytesIO объекта
+    Для DownloadedMedia возвращает хеш, посчитанный во время загрузки
     """
+    if isinstance(file_data, DownloadedMedia):
+        return file_data.data_hash
     if not isinstance(file_data, io.BytesIO):
         return None
 
     try:
         file_data.seek(0)  # Возвращаемся в начало файла
-        file_hash = hashlib.sha256(file_data.read()).hexdigest()
+        hasher = hashlib.sha256()
+        for chunk in iter(lambda: file_data.read(DOWNLOAD_CHUNK_SIZE), b''):
+            hasher.update(chunk)
         file_data.seek(0)  # Возвращаемся в начало для последующего использования
-        return file_hash
+        return hasher.digest()
     except Exception as e:
-        print(f"Ошибка вычисления хеша: {e}")
+        logger.error("Ошибка вычисления хеша: %s", e)
         return None
 
+def calculate_perceptual_hash(file_data):
+    """
+    Вычисляет 64-битный dHash изображения: картинка уменьшается до 9x8 в оттенках серого,
+    каждый бит - сравнение яркости соседних пикселей в строке
+    Устойчив к пересжатию и изменению размера. Возвращает None, если Pillow недоступен
+    """
+    if Image is None or not PHASH_ENABLED:
+        return None
+
+    try:
+        file_data.seek(0)
+        with Image.open(file_data) as image:
+            pixels = list(image.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+        phash = 0
+        for row in range(8):
+            for col in range(8):
+                phash = (phash << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+        return phash
+    except Exception as e:
+        logger.error("Ошибка вычисления перцептивного хеша: %s", e)
+        return None
+    finally:
+        file_data.seek(0)
+
 # ==================== Конец функций для работы с БД ====================
 
 def get_file_size(message):
@@ -130,6 +1634,39 @@ def get_file_size(message):
         return message.audio.file_size if hasattr(message.audio, 'file_size') else None
     return None
 
+def get_media_type(message):
+    """Определяет тип медиа в сообщении"""
+    for media_type in ('photo', 'video', 'animation', 'document', 'audio'):
+        if getattr(message, media_type):
+            return media_type
+    return None
+
+def should_hash_media(message):
+    """
+    Проверяет, нужно ли скачивать и хешировать медиа согласно политике пересылки
+    Если нет, медиа дедуплицируется только по file_id и отправляется по нему
+    """
+    if get_media_type(message) in HASH_SKIP_MEDIA_TYPES:
+        return False
+    file_size = get_file_size(message)
+    if HASH_MAX_FILE_SIZE is not None and file_size is not None and file_size > HASH_MAX_FILE_SIZE:
+        return False
+    return True
+
+def get_file_unique_id(message):
+    """Извлекает file_unique_id из сообщения (постоянен для файла, в отличие от file_id)"""
+    if message.photo:
+        return message.photo[-1].file_unique_id
+    elif message.video:
+        return message.video.file_unique_id
+    elif message.animation:
+        return message.animation.file_unique_id
+    elif message.document:
+        return message.document.file_unique_id
+    elif message.audio:
+        return message.audio.file_unique_id
+    return None
+
 def get_file_id(message):
     """Извлекает file_id из сообщения"""
     if message.photo:
@@ -144,34 +1681,202 @@ def get_file_id(message):
         return message.audio.file_id
     return None
 
-def download_media_file(file_info):
+def download_media_file(file_info, compute_phash=False):
     """
-    Скачивает медиафайл и возвращает его как BytesIO объект
-    Использует многопоточность для избежания блокировки
+    Потоково скачивает медиафайл и возвращает его как DownloadedMedia объект
+    Хеш считается по мере получения кусков, крупные файлы сбрасываются на диск
+    Для фотографий (compute_phash) дополнительно вычисляется перцептивный хеш
+    Соединения берутся из общего пула, число одновременных загрузок ограничивает download_limiter
     """
+    file_data = None
+    latency = None
+    started = time.perf_counter()
+    hash_seconds = 0.0
+    download_limiter.acquire()
     try:
-        file_url = f"https://api.telegram.org/file/bot{API_TOKEN}/{file_info.file_path}"
-        response = requests.get(file_url, timeout=30)
-        if response.status_code == 200:
-            return io.BytesIO(response.content)
-        else:
-            print(f"Ошибка скачивания {file_info.file_id}: {response.status_code}")
-            return None
+        with http_session.get(get_file_url(file_info), timeout=30, stream=True) as response:
+            latency = response.elapsed.total_seconds()
+            if response.status_code != 200:
+                logger.error("Ошибка скачивания %s: %s", file_info.file_id, response.status_code)
+                latency = None
+                return None
+
+            file_data = DownloadedMedia()
+            hasher = hashlib.sha256()
+            prefix_hasher = hashlib.sha256()
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                hash_started = time.perf_counter()
+                hasher.update(chunk)
+                prefix_remaining = PREFIX_FINGERPRINT_BYTES - file_data.tell()
+                if prefix_remaining > 0:
+                    prefix_hasher.update(chunk[:prefix_remaining])
+                hash_seconds += time.perf_counter() - hash_started
+                file_data.write(chunk)
+
+        file_data.data_hash = hasher.digest()
+        file_data.size = file_data.tell()
+        if file_data.size >= PREFIX_MIN_FILE_SIZE:
+            file_data.prefix_hash = prefix_hasher.digest()
+        metrics.inc('tgbot_stage_bytes_total', file_data.size, (('stage', 'download'),))
+        observe_stage('hash', hash_seconds)
+        file_data.seek(0)
+        if compute_phash:
+            with measure_stage('phash'):
+                file_data.phash = calculate_perceptual_hash(file_data)
+        return file_data
+    except Exception as e:
+        logger.error("Ошибка загрузки файла %s: %s", file_info.file_id, e)
+        release_media_data(file_data)
+        latency = None
+        return None
+    finally:
+        download_limiter.release(latency, error=latency is None)
+        observe_stage('download', time.perf_counter() - started, error=latency is None)
+
+@timed_stage('get_file')
+def get_file_info(file_id):
+    """Запрашивает у Bot API сведения о файле (путь для скачивания и размер)"""
+    return bot.get_file(file_id)
+
+def get_file_url(file_info):
+    """Возвращает URL для скачивания файла"""
+    return f"{TELEGRAM_API_URL}/file/bot{API_TOKEN}/{file_info.file_path}"
+
+def download_media_prefix(file_info):
+    """
+    Скачивает первые PREFIX_FINGERPRINT_BYTES байт файла запросом Range и возвращает их SHA256
+    Возвращает None, если сервер не поддержал Range или загрузка не удалась
+    """
+    latency = None
+    started = time.perf_counter()
+    download_limiter.acquire()
+    try:
+        headers = {'Range': f'bytes=0-{PREFIX_FINGERPRINT_BYTES - 1}'}
+        with http_session.get(get_file_url(file_info), headers=headers, timeout=30, stream=True) as response:
+            latency = response.elapsed.total_seconds()
+            if response.status_code != 206:
+                return None
+            hasher = hashlib.sha256()
+            received = 0
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                hasher.update(chunk[:PREFIX_FINGERPRINT_BYTES - received])
+                received += len(chunk)
+                if received >= PREFIX_FINGERPRINT_BYTES:
+                    break
+            metrics.inc('tgbot_stage_bytes_total', min(received, PREFIX_FINGERPRINT_BYTES), (('stage', 'download_prefix'),))
+            return hasher.digest()
     except Exception as e:
-        print(f"Ошибка загрузки файла {file_info.file_id}: {e}")
+        logger.error("Ошибка загрузки начала файла %s: %s", file_info.file_id, e)
+        latency = None
         return None
+    finally:
+        download_limiter.release(latency, error=latency is None)
+        observe_stage('download_prefix', time.perf_counter() - started, error=latency is None)
 
-def download_media_file_async(file_info, callback, *callback_args):
+def resolve_prefix_candidates(candidates):
+    """
+    Досчитывает полный хеш медиа-кандидатов, для которых в БД записан только отпечаток начала
+    Кандидаты скачиваются по сохраненному file_id, хеш записывается в БД, чтобы обычная
+    проверка по хешу смогла найти дубликат
+    """
+    for file_id, message_id, data_hash in candidates:
+        if data_hash is not None:
+            continue
+        try:
+            candidate_data = download_media_file(get_file_info(file_id))
+        except Exception as e:
+            logger.error("Не удалось скачать кандидата %s для сверки хеша: %s", file_id, e)
+            continue
+        if candidate_data:
+            add_media_to_database(file_id, message_id, candidate_data.data_hash, candidate_data.size,
+                                  prefix_hash=candidate_data.prefix_hash)
+            release_media_data(candidate_data)
+
+def fetch_media_fingerprint(file_info, compute_phash=False):
+    """
+    Получает отпечаток медиа для дедупликации
+    Для крупных файлов сначала скачивается только начало: если в БД нет медиа того же размера
+    с тем же началом, файл точно новый, и возвращается MediaFingerprint без содержимого.
+    Иначе (а также для небольших файлов и фото, которым нужен перцептивный хеш) файл
+    скачивается целиком и возвращается DownloadedMedia
+    """
+    file_size = getattr(file_info, 'file_size', None)
+    if compute_phash or not file_size or file_size < PREFIX_MIN_FILE_SIZE:
+        return download_media_file(file_info, compute_phash)
+
+    prefix_hash = download_media_prefix(file_info)
+    if prefix_hash is not None:
+        candidates = dedup_store.find_prefix_candidates(file_size, prefix_hash)
+        if not candidates:
+            logger.debug("Начало файла %s не совпадает ни с одним медиа в БД, полная загрузка не нужна",
+                         file_info.file_id)
+            return MediaFingerprint(file_size, prefix_hash)
+        resolve_prefix_candidates(candidates)
+    return download_media_file(file_info, compute_phash)
+
+def release_media_data(file_data):
+    """Освобождает память или временный файл, занятые скачанным медиа, и его часть бюджета памяти"""
+    if isinstance(file_data, DownloadedMedia):
+        file_data.close()
+        memory_budget.release(file_data.reserved_bytes)
+        file_data.reserved_bytes = 0
+
+def reserve_download_memory(message):
+    """
+    Резервирует бюджет памяти под загрузку медиа из сообщения
+    Возвращает количество зарезервированных байт или None, если бюджет исчерпан
+    и медиа нужно отправить по file_id без загрузки
+    """
+    file_size = get_file_size(message) or DOWNLOAD_SPOOL_THRESHOLD
+    reserved_bytes = min(file_size, DOWNLOAD_SPOOL_THRESHOLD)
+    if not memory_budget.try_reserve(reserved_bytes):
+        return None
+    return reserved_bytes
+
+def get_memory_status():
+    """Возвращает текстовое описание занятого бюджета памяти"""
+    megabyte = 1024 * 1024
+    return (f"Память под медиа: {memory_budget.used / megabyte:.1f} из {memory_budget.limit / megabyte:.0f} МБ "
+            f"(пик {memory_budget.peak / megabyte:.1f} МБ), отправлено по ID из-за лимита: {memory_budget.rejected}")
+
+def download_media_file_async(file_info, callback, *callback_args, compute_phash=False, reserved_bytes=0):
     """
     Запускает асинхронную загрузку файла и вызывает callback по завершению
+    reserved_bytes - зарезервированный под файл бюджет памяти, он освобождается вместе с файлом
     """
     def download_wrapper():
-        file_data = download_media_file(file_info)
+        file_data = fetch_media_fingerprint(file_info, compute_phash)
+        if file_data and journal is not None:
+            try:
+                journal.record_media(file_info.file_id, file_data)
+            except Exception as e:
+                logger.error("Не удалось записать медиа %s в журнал: %s", file_info.file_id, e)
+        if not isinstance(file_data, DownloadedMedia):
+            memory_budget.release(reserved_bytes)
+        else:
+            file_data.reserved_bytes = reserved_bytes
         callback(file_data, *callback_args)
     download_executor.submit(download_wrapper)
 
+def start_media_download(file_id, callback, *callback_args, compute_phash=False, reserved_bytes=0):
+    """
+    Запускает загрузку медиа по file_id (см. download_media_file_async)
+    Медиа, скачанное до перезапуска и сохраненное в журнале, берется оттуда без обращения к сети
+    """
+    file_data = journal.load_media(file_id) if journal is not None else None
+    if file_data is None:
+        download_media_file_async(get_file_info(file_id), callback, *callback_args, compute_phash=compute_phash,
+                                  reserved_bytes=reserved_bytes)
+        return
+    logger.debug("Медиа %s восстановлено из журнала без повторной загрузки", file_id)
+    if isinstance(file_data, DownloadedMedia):
+        file_data.reserved_bytes = reserved_bytes
+    else:
+        memory_budget.release(reserved_bytes)
+    callback(file_data, *callback_args)
+
 def create_input_media(message, file_data):
-    """Создает объект InputMedia для отправки"""
+    """Создает объект InputMedia для отправки (file_data - file_id или файловый объект)"""
     if message.photo:
         return types.InputMediaPhoto(media=file_data)
     elif message.video:
@@ -186,218 +1891,735 @@ def create_input_media(message, file_data):
         return types.InputMediaAudio(media=file_data)
     return None
 
+# ==================== Исходящие отправки ====================
+
+# Объединение одиночных медиа в альбомы (None - каждое медиа отправляется отдельно)
+SINGLE_MEDIA_BATCH_WINDOW = None  # Сколько секунд ждать следующих одиночных медиа
+SINGLE_MEDIA_BATCH_SIZE = 10  # Максимальный размер альбома в Telegram
+
+# Типы медиа, которые можно объединять, и группы совместимости внутри альбома:
+# фото и видео смешиваются, документы и аудио - только с медиа своего типа
+MEDIA_GROUP_KINDS = {'photo': 'visual', 'video': 'visual', 'document': 'document', 'audio': 'audio'}
+
+single_media_batch = []  # [(message, file_data, claim)] копящийся альбом одиночных медиа и их резервы
+single_media_batch_kind = None
+single_media_batch_lock = threading.Lock()
+
+# Копящийся альбом отправляется по таймеру на собственном потоке: медиа альбома держат свои резервы
+# до записи в БД, и потоки пула отправки могут быть заняты ожиданием этих резервов
+single_media_batch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+single_media_batch_scheduler = DeadlineScheduler(single_media_batch_executor)
+
+# Ограничения на отправку в один чат (в группах Telegram допускает около 20 сообщений в минуту,
+# каждое медиа альбома считается отдельным сообщением)
+SEND_RATE_PER_MINUTE = 20
+SEND_BURST = 10  # Сколько сообщений можно отправить подряд без ожидания (не меньше размера альбома)
+SEND_MAX_RETRIES = 8  # Количество повторов при 429 и временных ошибках
+SEND_RETRY_BASE_DELAY = 2.0  # Начальная задержка повтора при временной ошибке, в секундах
+
+class TokenBucket:
+    """Ограничитель скорости «ведро с токенами»"""
+    def __init__(self, rate, capacity):
+        self.rate = rate  # Токенов в секунду
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, count=1):
+        """Ждет, пока в ведре не наберется count токенов, и забирает их"""
+        count = min(count, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= count:
+                    self.tokens -= count
+                    return
+                wait = max(self.blocked_until - now, (count - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def block(self, seconds):
+        """Запрещает отправку на указанное время (после ответа 429) и опустошает ведро"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+class OutboundSendQueue:
+    """
+    Очередь исходящих отправок в один чат
+    Отправки выполняются по одной на отдельном потоке с учетом ограничения скорости,
+    при 429 выдерживается retry_after, временные ошибки повторяются с экспоненциальной задержкой
+    """
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.bucket = TokenBucket(SEND_RATE_PER_MINUTE / 60, SEND_BURST)
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=f"outbound-{chat_id}", daemon=True)
+        self.thread.start()
+
+    def submit(self, items):
+        """Ставит альбом в очередь, возвращает Future со списком отправленных сообщений"""
+        future = concurrent.futures.Future()
+        self.jobs.put((items, future))
+        return future
+
+    def _run(self):
+        while True:
+            items, future = self.jobs.get()
+            try:
+                future.set_result(self._send_with_retries(items))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _send_with_retries(self, items):
+        attempt = 0
+        while True:
+            self.bucket.acquire(len(items))
+            try:
+                return deliver_media_items(self.chat_id, items)
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429 and attempt < SEND_MAX_RETRIES:
+                    retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', SEND_RETRY_BASE_DELAY)
+                    logger.warning("Превышен лимит отправки в чат %s, повтор через %s с", self.chat_id, retry_after)
+                    metrics.inc('tgbot_send_retries_total', 1, (('reason', 'rate_limit'),))
+                    self.bucket.block(retry_after)
+                elif e.error_code >= 500 and attempt < SEND_MAX_RETRIES:
+                    delay = SEND_RETRY_BASE_DELAY * 2 ** attempt
+                    logger.warning("Ошибка сервера при отправке в чат %s (%s), повтор через %s с",
+                                   self.chat_id, e, delay)
+                    metrics.inc('tgbot_send_retries_total', 1, (('reason', 'server_error'),))
+                    time.sleep(delay)
+                else:
+                    raise
+            except requests.exceptions.RequestException as e:
+                if attempt >= SEND_MAX_RETRIES:
+                    raise
+                delay = SEND_RETRY_BASE_DELAY * 2 ** attempt
+                logger.warning("Сетевая ошибка при отправке в чат %s (%s), повтор через %s с", self.chat_id, e, delay)
+                metrics.inc('tgbot_send_retries_total', 1, (('reason', 'network'),))
+                time.sleep(delay)
+            attempt += 1
+
+outbound_queues = {}
+outbound_queues_lock = threading.Lock()
+
+def is_file_id_rejected(error):
+    """Проверяет, что Telegram отказался принять медиа по file_id"""
+    if not isinstance(error, telebot.apihelper.ApiTelegramException) or error.error_code != 400:
+        return False
+    description = str(error.description).lower()
+    return "file identifier" in description or "file_id" in description or "file_reference" in description
+
+def deliver_media_items(chat_id, items):
+    """
+    Отправляет медиа в чат одним альбомом, items - список (message, file_data)
+    По умолчанию медиа отправляется по исходному file_id, скачанные данные
+    загружаются заново только если Telegram отклонил file_id
+    Вызывается только из потока очереди отправки этого чата
+    """
+    def build_input_media_list(upload):
+        input_media_list = []
+        for message, file_data in items:
+            if upload and isinstance(file_data, DownloadedMedia):
+                file_data.seek(0)
+                media = file_data
+            else:
+                media = get_file_id(message)
+            input_media = create_input_media(message, media)
+            if input_media:
+                input_media_list.append(input_media)
+        return input_media_list
+
+    if not RESEND_BY_FILE_ID:
+        with measure_stage('send'):
+            return bot.send_media_group(chat_id, build_input_media_list(upload=True))
+
+    try:
+        with measure_stage('send'):
+            return bot.send_media_group(chat_id, build_input_media_list(upload=False))
+    except Exception as e:
+        has_uploads = any(isinstance(file_data, DownloadedMedia) for _, file_data in items)
+        if not has_uploads or not is_file_id_rejected(e):
+            raise
+        logger.warning("Telegram отклонил file_id (%s), загружаем скачанные данные", e)
+        with measure_stage('send'):
+            return bot.send_media_group(chat_id, build_input_media_list(upload=True))
+
+def get_outbound_queue(chat_id):
+    """Возвращает очередь отправки для чата, создавая ее при первом обращении"""
+    with outbound_queues_lock:
+        outbound_queue = outbound_queues.get(chat_id)
+        if outbound_queue is None:
+            outbound_queue = OutboundSendQueue(chat_id)
+            outbound_queues[chat_id] = outbound_queue
+        return outbound_queue
+
+def send_media_items(items):
+    """
+    Отправляет медиа в целевой чат через его очередь отправки и ждет результата
+    Очередь соблюдает ограничения Telegram и повторяет отправку при 429 и сетевых ошибках
+    """
+    return get_outbound_queue(TARGET_CHAT_ID).submit(items).result()
+
 def send_error_notification(chat_id, error_message, original_message=None):
     """Отправляет уведомление об ошибке пользователю"""
     try:
-        print(error_message)
+        logger.error(error_message)
         if original_message:
             bot.send_message(chat_id, error_message, reply_to_message_id=original_message.message_id)
         else:
             bot.send_message(chat_id, error_message)
-        print(f"(Уведомление об ошибке отправлено в чат {chat_id})")
+        logger.debug("(Уведомление об ошибке отправлено в чат %s)", chat_id)
     except Exception as e:
-        print(f"Не удалось отправить уведомление об ошибке: {e}")
+        logger.error("Не удалось отправить уведомление об ошибке: %s", e)
 
-def send_media_group(media_group_id):
-    """Отправляет собранный медиа-альбом в порядке message_id, без текста"""
+def claim_media_keys(keys):
+    """
+    Резервирует ключи медиа (file_unique_id, хеш) на время дедупликации и отправки
+    Если часть ключей уже занята другим альбомом, ждет его завершения, чтобы одно и то же
+    медиа из параллельных альбомов не было отправлено дважды. Ключи резервируются разом,
+    поэтому альбомы не могут заблокировать друг друга. Внутри процесса ожидание идет
+    по событиям, затем ключи резервируются в хранилище для остальных процессов
+    """
+    while True:
+        with inflight_media_lock:
+            busy = {inflight_media_keys[key] for key in keys if key in inflight_media_keys}
+            if not busy:
+                event = threading.Event()
+                for key in keys:
+                    inflight_media_keys[key] = event
+                break
+        for event in busy:
+            event.wait()
+
+    store_keys = get_store_claim_keys(keys)
+    try:
+        while not dedup_store.try_claim(store_keys, PROCESS_ID, CLAIM_TTL):
+            time.sleep(CLAIM_POLL_INTERVAL)
+    except Exception:
+        release_media_keys(keys, event, release_store=False)
+        raise
+    hold_store_claims(event, store_keys)
+    return event
+
+def release_media_keys(keys, event, release_store=True):
+    """
+    Освобождает ключи, зарезервированные claim_media_keys
+    release_store=False не обращается к хранилищу (резерв в нем не был получен)
+    """
+    if release_store:
+        # Под блокировкой продления: продление не вернет резерв после его снятия
+        with held_store_claims_lock:
+            held_store_claims.pop(event, None)
+            release_store_claims(keys)
+    with inflight_media_lock:
+        for key in keys:
+            if inflight_media_keys.get(key) is event:
+                del inflight_media_keys[key]
+    event.set()
+
+def release_store_claims(keys):
+    """Снимает резервы ключей в хранилище"""
+    try:
+        dedup_store.release(get_store_claim_keys(keys), PROCESS_ID)
+    except Exception as e:
+        logger.error("Не удалось снять резерв ключей медиа: %s", e)
+
+# Резервы в хранилище, которые держит этот процесс (Event резерва -> ключи в хранилище).
+# Отправка может долго ждать в очереди чата, поэтому резервы продлеваются, пока не будут сняты
+held_store_claims = {}
+held_store_claims_lock = threading.Lock()
+claim_renewal_thread = None
+
+def hold_store_claims(event, store_keys):
+    """Запоминает полученный резерв для продления, при первом вызове запускает поток продления"""
+    global claim_renewal_thread
+    with held_store_claims_lock:
+        held_store_claims[event] = store_keys
+        if claim_renewal_thread is None:
+            claim_renewal_thread = threading.Thread(target=renew_store_claims, name="claim-renewal", daemon=True)
+            claim_renewal_thread.start()
+
+def renew_store_claims():
+    """Раз в CLAIM_RENEW_INTERVAL секунд продлевает на CLAIM_TTL все удерживаемые резервы"""
+    while True:
+        time.sleep(CLAIM_RENEW_INTERVAL)
+        with held_store_claims_lock:
+            for store_keys in held_store_claims.values():
+                try:
+                    if not dedup_store.try_claim(store_keys, PROCESS_ID, CLAIM_TTL):
+                        logger.warning("Резерв ключей медиа истек и занят другим процессом: %s", store_keys)
+                except Exception as e:
+                    logger.error("Не удалось продлить резерв ключей медиа: %s", e)
+
+def get_store_claim_keys(keys):
+    """Переводит ключи медиа в строки для резервов в хранилище"""
+    return [f"u:{value}" if kind == 'file_unique_id' else f"h:{value.hex()}" for kind, value in keys]
+
+def get_message_media_keys(message, file_data):
+    """Возвращает ключи содержимого одного медиа для claim_media_keys"""
+    keys = set()
+    file_unique_id = get_file_unique_id(message)
+    if file_unique_id:
+        keys.add(('file_unique_id', file_unique_id))
+    data_hash = getattr(file_data, 'data_hash', None)
+    if data_hash:
+        keys.add(('hash', data_hash))
+    return keys
+
+def get_media_keys(media_list):
+    """Возвращает ключи содержимого медиа альбома для claim_media_keys"""
+    keys = set()
+    for _, (message, file_data) in media_list:
+        keys |= get_message_media_keys(message, file_data)
+    return keys
+
+def collect_media_group(media_group_id):
+    """
+    Стадия сбора: под блокировкой забирает готовый альбом из общих таблиц
+    Возвращает список (message_id, (message, file_data)) в порядке message_id
+    или None, если альбом еще не готов
+    """
     with media_groups_lock:
         # Проверяем, есть ли еще загружающиеся файлы
         if media_groups_downloading.get(media_group_id, 0) > 0:
-            print(f"В группе {media_group_id} еще есть загружающиеся файлы, откладываем отправку")
-            # Перезапускаем таймер еще на 1 секунду
-            schedule_media_group_send(media_group_id, delay=1.0)
-            return
+            # Отправка будет запланирована сразу после завершения последней загрузки
+            logger.debug("В группе %s еще есть загружающиеся файлы, откладываем отправку", media_group_id)
+            media_groups_ready.add(media_group_id)
+            return None
 
-        media_list = media_groups_by_msgid[media_group_id]
-        if len(media_list) < 1:
-            return
+        media_list = media_groups_by_msgid.pop(media_group_id, [])
+        media_groups.pop(media_group_id, None)
+        media_groups_downloading.pop(media_group_id, None)
+        media_groups_ready.discard(media_group_id)
+        started = media_groups_started.pop(media_group_id, None)
 
-        # Сортируем по message_id
-        media_list.sort(key=lambda x: x[0])
+    if started is not None:
+        observe_stage('album_wait', time.perf_counter() - started)
 
-        # Проверяем каждое медиа на дедупликацию
-        media_to_send = []  # [(message, file_data, file_id, file_hash, file_size)]
-        duplicates = []  # [(message, existing_message_id, reason)]
+    # Сортируем по message_id
+    media_list.sort(key=lambda x: x[0])
+    return media_list
 
-        for _, (message, file_data) in media_list:
-            file_id = get_file_id(message)
-            if not file_id:
-                continue
+def deduplicate_media_group(media_list):
+    """
+    Стадия дедупликации: проверяет каждое медиа альбома по базе данных
+    Возвращает (media_to_send, duplicates)
+    """
+    media_to_send = []  # [(message, file_data, file_id, file_hash, file_size)]
+    duplicates = []  # [(message, existing_message_id, reason)]
+
+    # Для всего альбома делаем по одному запросу на каждый вид ключа
+    known_unique_ids = dedup_store.find_by_unique_ids([get_file_unique_id(message) for _, (message, _) in media_list])
+    known_file_ids = dedup_store.find_by_file_ids([get_file_id(message) for _, (message, _) in media_list])
+    known_hashes = dedup_store.find_by_hashes([(file_data.data_hash, file_data.size) for _, (_, file_data) in media_list
+                                               if getattr(file_data, 'data_hash', None)])
+
+    for _, (message, file_data) in media_list:
+        file_id = get_file_id(message)
+        if not file_id:
+            continue
+
+        # Проверяем по file_unique_id
+        file_unique_id = get_file_unique_id(message)
+        existing_message_id = known_unique_ids.get(file_unique_id)
+        if existing_message_id is not None:
+            duplicates.append((message, existing_message_id, "file_unique_id"))
+            logger.info("Дубликат в альбоме найден по file_unique_id: %s, message_id: %s",
+                        file_unique_id, existing_message_id)
+            continue
+
+        # Проверяем по file_id
+        existing_message_id = known_file_ids.get(file_id)
+        if existing_message_id is not None:
+            duplicates.append((message, existing_message_id, "file_id"))
+            logger.info("Дубликат в альбоме найден по file_id: %s, message_id: %s", file_id, existing_message_id)
+            continue
+
+        # Если файл скачан (сейчас или до перезапуска), проверяем по хешу, посчитанному при загрузке
+        file_hash = None
+        file_size = None
+        if isinstance(file_data, (DownloadedMedia, MediaFingerprint)) and file_data.data_hash:
+            file_hash = file_data.data_hash
+            file_size = file_data.size
+
+            if file_hash:
+                existing_message_id = known_hashes.get((file_hash, file_size))
+                if existing_message_id is not None:
+                    duplicates.append((message, existing_message_id, "hash"))
+                    logger.info("Дубликат в альбоме найден по хешу: %s, message_id: %s",
+                                file_hash.hex(), existing_message_id)
+                    continue
 
-            # Проверяем по file_id
-            existing_message_id = check_media_by_file_id(file_id)
-            if existing_message_id:
-                duplicates.append((message, existing_message_id, "file_id"))
-                print(f"Дубликат в альбоме найден по file_id: {file_id}, message_id: {existing_message_id}")
+            # Проверяем фото на похожесть по перцептивному хешу
+            existing_message_id = check_media_by_phash(file_data.phash)
+            if existing_message_id is not None:
+                duplicates.append((message, existing_message_id, "phash"))
+                logger.info("Похожее фото в альбоме найдено по перцептивному хешу: %016x, message_id: %s",
+                            file_data.phash, existing_message_id)
                 continue
+        elif isinstance(file_data, MediaFingerprint):
+            # Начало файла не совпало ни с одним медиа в БД, значит медиа новое
+            file_size = file_data.size
 
-            # Если файл скачан (BytesIO), проверяем по хешу
-            file_hash = None
-            file_size = None
-            if isinstance(file_data, io.BytesIO):
-                file_hash = calculate_file_hash(file_data)
-                file_size = get_file_size(message)
-
-                if file_hash:
-                    existing_message_id = check_media_by_hash(file_hash, file_size)
-                    if existing_message_id:
-                        duplicates.append((message, existing_message_id, "hash"))
-                        print(f"Дубликат в альбоме найден по хешу: {file_hash}, message_id: {existing_message_id}")
-                        continue
+        # Медиа не дубликат, добавляем в список для отправки
+        media_to_send.append((message, file_data, file_id, file_hash, file_size))
 
-            # Медиа не дубликат, добавляем в список для отправки
-            media_to_send.append((message, file_data, file_id, file_hash, file_size))
+    return media_to_send, duplicates
 
-        # Отправляем уведомления о дубликатах
-        if duplicates:
-            first_message = duplicates[0][0]
-            dup_count = len(duplicates)
-            if dup_count == 1:
-                msg, existing_id, reason = duplicates[0]
-                bot.reply_to(msg, f"⚠️ Это медиа уже было отправлено ранее (message_id: {existing_id})")
-            else:
-                dup_msg = f"⚠️ {dup_count} медиа из этого альбома уже были отправлены ранее"
-                bot.reply_to(first_message, dup_msg)
+def send_deduplicated_media_group(media_group_id, media_list, media_to_send, duplicates):
+    """Стадия отправки: уведомляет о дубликатах и отправляет новые медиа альбома"""
+    # Отправляем уведомления о дубликатах
+    for _, _, reason in duplicates:
+        metrics.inc('tgbot_duplicates_total', 1, (('reason', reason),))
+    if duplicates:
+        first_message = duplicates[0][0]
+        dup_count = len(duplicates)
+        if dup_count == 1:
+            msg, existing_id, reason = duplicates[0]
+            bot.reply_to(msg, f"⚠️ Это медиа уже было отправлено ранее (message_id: {existing_id})")
+        else:
+            dup_msg = f"⚠️ {dup_count} медиа из этого альбома уже были отправлены ранее"
+            bot.reply_to(first_message, dup_msg)
 
-        # Отправляем новые медиа
-        if len(media_to_send) > 0:
-            try:
-                # Создаем список InputMedia для всех файлов (и для одиночных, и для альбомов)
-                input_media_list = []
-                for message, file_data, _, _, _ in media_to_send:
-                    input_media = create_input_media(message, file_data)
-                    if input_media:
-                        input_media_list.append(input_media)
+    # Отправляем новые медиа
+    if len(media_to_send) > 0:
+        try:
+            # Отправляем через send_media_group независимо от количества файлов
+            sent_messages = send_media_items([(message, file_data) for message, file_data, _, _, _ in media_to_send])
 
-                # Отправляем через send_media_group независимо от количества файлов
-                sent_messages = bot.send_media_group(TARGET_CHAT_ID, input_media_list)
+            # Добавляем отправленные медиа в базу данных
+            for i, (message, file_data, file_id, file_hash, file_size) in enumerate(media_to_send):
+                if i < len(sent_messages):
+                    add_media_to_database(file_id, sent_messages[i].message_id, file_hash, file_size,
+                                          get_file_unique_id(message), getattr(file_data, 'phash', None),
+                                          getattr(file_data, 'prefix_hash', None))
 
-                # Добавляем отправленные медиа в базу данных
-                for i, (message, file_data, file_id, file_hash, file_size) in enumerate(media_to_send):
-                    if i < len(sent_messages):
-                        add_media_to_database(file_id, sent_messages[i].message_id, file_hash, file_size)
+            logger.info("Медиа-альбом %s успешно отправлен (%s новых, %s дубликатов)",
+                        media_group_id, len(media_to_send), len(duplicates))
 
-                print(f"Медиа-альбом {media_group_id} успешно отправлен ({len(media_to_send)} новых, {len(duplicates)} дубликатов)")
+        except Exception as e:
+            error_msg = f"Ошибка отправки медиа-альбома {media_group_id}:\n{str(e)}"
+            logger.error(error_msg)
+            # Отправляем уведомление об ошибке для первого сообщения в группе
+            if media_list:
+                first_message = media_list[0][1][0]
+                send_error_notification(first_message.chat.id, error_msg, first_message)
+    elif len(duplicates) == 0:
+        logger.info("Медиа-альбом %s пуст после обработки", media_group_id)
 
-            except Exception as e:
-                error_msg = f"Ошибка отправки медиа-альбома {media_group_id}:\n{str(e)}"
-                print(error_msg)
-                # Отправляем уведомление об ошибке для первого сообщения в группе
-                if media_list:
-                    first_message = media_list[0][1][0]
-                    send_error_notification(first_message.chat.id, error_msg, first_message)
-        elif len(duplicates) == 0:
-            print(f"Медиа-альбом {media_group_id} пуст после обработки")
+def send_media_group(media_group_id):
+    """
+    Отправляет собранный медиа-альбом в порядке message_id, без текста
+    Под общей блокировкой выполняется только сбор альбома, дедупликация и отправка
+    идут без нее, поэтому разные альбомы обрабатываются параллельно
+    """
+    media_list = collect_media_group(media_group_id)
+    if media_list is None:
+        # Отправка отложена до завершения загрузок
+        return
+    if not media_list:
+        finish_journaled_media_group(media_group_id)
+        return
 
+    media_keys = get_media_keys(media_list)
+    claim_event = None
+    try:
+        claim_event = claim_media_keys(media_keys)
+        media_to_send, duplicates = deduplicate_media_group(media_list)
+        send_deduplicated_media_group(media_group_id, media_list, media_to_send, duplicates)
+    except Exception as e:
+        error_msg = f"Ошибка обработки медиа-альбома {media_group_id}:\n{str(e)}"
+        first_message = media_list[0][1][0]
+        send_error_notification(first_message.chat.id, error_msg, first_message)
+    finally:
+        if claim_event is not None:
+            release_media_keys(media_keys, claim_event)
         # Очистка после обработки
-        if media_group_id in media_groups_by_msgid:
-            del media_groups_by_msgid[media_group_id]
-        if media_group_id in media_groups:
-            del media_groups[media_group_id]
-        if media_group_id in media_groups_timers:
-            del media_groups_timers[media_group_id]
-        if media_group_id in media_groups_downloading:
-            del media_groups_downloading[media_group_id]
-
-def schedule_media_group_send(media_group_id, delay=3.0):
-    """Планирует отправку медиа-альбома через указанное количество секунд"""
-    if media_group_id in media_groups_timers:
-        # Отменяем предыдущий таймер
-        media_groups_timers[media_group_id].cancel()
-    timer = threading.Timer(delay, send_media_group, [media_group_id])
-    timer.daemon = True
-    timer.start()
-    media_groups_timers[media_group_id] = timer
+        for _, (_, file_data) in media_list:
+            release_media_data(file_data)
+        finish_journaled_media_group(media_group_id)
+
+def schedule_media_group_send(media_group_id, delay=MEDIA_GROUP_DEBOUNCE):
+    """Планирует отправку медиа-альбома через указанное количество секунд, перенося предыдущий дедлайн"""
+    scheduler.schedule(('media_group', media_group_id), delay, send_media_group, media_group_id)
+
+def finish_media_group_download(media_group_id):
+    """
+    Уменьшает счетчик загрузок группы (вызывается под media_groups_lock)
+    Если ожидание новых медиа уже истекло и это была последняя загрузка, альбом отправляется сразу
+    """
+    if media_group_id not in media_groups_downloading:
+        return
+    media_groups_downloading[media_group_id] -= 1
+    if media_groups_downloading[media_group_id] <= 0 and media_group_id in media_groups_ready:
+        media_groups_ready.discard(media_group_id)
+        schedule_media_group_send(media_group_id, delay=0)
 
 def media_group_download_callback(file_data, media_group_id, message):
     """Callback для завершения загрузки файла в медиа-группе"""
     with media_groups_lock:
         if media_group_id in media_groups_downloading:
-            media_groups_downloading[media_group_id] -= 1
+            finish_media_group_download(media_group_id)
             if file_data:
                 # Добавляем загруженный файл в структуру с сортировкой по message_id
                 media_groups_by_msgid[media_group_id].append((message.message_id, (message, file_data)))
-                print(f"Загружено медиа для группы {media_group_id}, всего: {len(media_groups_by_msgid[media_group_id])}, "
-                      f"еще загружается: {media_groups_downloading.get(media_group_id, 0)}")
+                logger.debug("Загружено медиа для группы %s, всего: %s, еще загружается: %s",
+                             media_group_id, len(media_groups_by_msgid[media_group_id]),
+                             media_groups_downloading.get(media_group_id, 0))
             else:
-                print(f"Ошибка загрузки медиа для группы {media_group_id}")
+                logger.error("Ошибка загрузки медиа для группы %s", media_group_id)
         else:
-            print(f"Группа {media_group_id} не указана как загружающая")
+            release_media_data(file_data)
+            logger.info("Группа %s не указана как загружающая", media_group_id)
+
+def add_media_to_group_by_id(message, media_group_id, file_id):
+    """Добавляет медиа в группу без загрузки, оно будет отправлено по file_id"""
+    with media_groups_lock:
+        media_groups_by_msgid[media_group_id].append((message.message_id, (message, file_id)))
+        finish_media_group_download(media_group_id)
+    logger.debug("Добавлено по ID медиа для группы %s, всего: %s, еще загружается: %s",
+                 media_group_id, len(media_groups_by_msgid[media_group_id]),
+                 media_groups_downloading.get(media_group_id, 0))
 
 def handle_message_from_media_group(message, media_group_id, file_id):
     # print("Обработка одного медиа из альбома...")
+    # Уже известное медиа не скачиваем, дубликат будет найден при отправке альбома
+    if not should_hash_media(message) or check_media_by_unique_id(get_file_unique_id(message)) is not None:
+        add_media_to_group_by_id(message, media_group_id, file_id)
+        return
+    reserved_bytes = reserve_download_memory(message)
+    if reserved_bytes is None:
+        logger.warning("Бюджет памяти исчерпан, медиа для группы %s будет отправлено по ID без проверки содержимого",
+                       media_group_id)
+        add_media_to_group_by_id(message, media_group_id, file_id)
+        return
     try:
         # print("Попытка загрузки...")
-        file_info = bot.get_file(file_id)
-        download_media_file_async(file_info, media_group_download_callback, media_group_id, message)
-        print(f"Начата загрузка медиа для группы {media_group_id}, всего загружается: {media_groups_downloading[media_group_id]}")
+        start_media_download(file_id, media_group_download_callback, media_group_id, message,
+                             compute_phash=bool(message.photo), reserved_bytes=reserved_bytes)
+        logger.debug("Начата загрузка медиа для группы %s, всего загружается: %s",
+                     media_group_id, media_groups_downloading[media_group_id])
     except Exception as e:
         # print("Попытка загрузки не удалась: " + str(e))
+        memory_budget.release(reserved_bytes)
         if "file is too big" in str(e).lower():
+            add_media_to_group_by_id(message, media_group_id, file_id)
+        else:
+            logger.error("Ошибка получения файла для группы %s: %s", media_group_id, e)
             with media_groups_lock:
-                if media_group_id in media_groups_downloading:
-                    media_groups_downloading[media_group_id] -= 1
-                media_groups_by_msgid[media_group_id].append((message.message_id, (message, file_id)))
-            print(f"Добавлено по ID медиа для группы {media_group_id}, всего: {len(media_groups_by_msgid[media_group_id])}, "
-                  f"еще загружается: {media_groups_downloading.get(media_group_id, 0)}")
+                finish_media_group_download(media_group_id)
+
+
+def is_in_single_media_batch(message, file_data):
+    """
+    Проверяет, ждет ли такое же медиа (по file_unique_id или хешу) в копящемся альбоме
+    Вызывается до claim_media_keys: резерв медиа из альбома снимается только после его отправки
+    """
+    file_unique_id = get_file_unique_id(message)
+    data_hash = getattr(file_data, 'data_hash', None)
+    with single_media_batch_lock:
+        for batch_message, batch_data, _ in single_media_batch:
+            if (file_unique_id and get_file_unique_id(batch_message) == file_unique_id) or \
+                    (data_hash and getattr(batch_data, 'data_hash', None) == data_hash):
+                return True
+    return False
 
+def add_to_single_media_batch(message, file_data, claim):
+    """
+    Добавляет одиночное медиа в копящийся альбом
+    Альбом отправляется, когда в нем SINGLE_MEDIA_BATCH_SIZE медиа, когда приходит медиа
+    несовместимого типа или через SINGLE_MEDIA_BATCH_WINDOW секунд после первого медиа
+    claim - резерв ключей медиа от claim_media_keys, он снимается после записи альбома в БД,
+    поэтому такое же медиа, успевшее зарезервировать ключи раньше проверки is_in_single_media_batch,
+    ждет отправки альбома и затем находится как дубликат
+    """
+    global single_media_batch, single_media_batch_kind
+    kind = MEDIA_GROUP_KINDS[get_media_type(message)]
+    ready_batches = []
+    with single_media_batch_lock:
+        if single_media_batch and kind != single_media_batch_kind:
+            ready_batches.append(single_media_batch)
+            single_media_batch = []
+        if not single_media_batch:
+            single_media_batch_kind = kind
+            single_media_batch_scheduler.schedule(('single_media_batch',), SINGLE_MEDIA_BATCH_WINDOW,
+                                                  flush_single_media_batch)
+        single_media_batch.append((message, file_data, claim))
+        if len(single_media_batch) >= SINGLE_MEDIA_BATCH_SIZE:
+            ready_batches.append(single_media_batch)
+            single_media_batch = []
+            single_media_batch_scheduler.cancel(('single_media_batch',))
+
+    for batch in ready_batches:
+        send_single_media_batch(batch)
+
+def flush_single_media_batch():
+    """Отправляет копящийся альбом одиночных медиа по истечении окна ожидания"""
+    global single_media_batch
+    with single_media_batch_lock:
+        batch = single_media_batch
+        single_media_batch = []
+    if batch:
+        send_single_media_batch(batch)
+
+def send_single_media_batch(batch):
+    """Отправляет одиночные медиа одним альбомом и записывает в БД каждое по своему сообщению"""
+    batch.sort(key=lambda item: item[0].message_id)
+    try:
+        sent_messages = send_media_items([(message, file_data) for message, file_data, _ in batch])
+        for i, (message, file_data, _) in enumerate(batch):
+            if i < len(sent_messages):
+                add_media_to_database(get_file_id(message), sent_messages[i].message_id,
+                                      getattr(file_data, 'data_hash', None), getattr(file_data, 'size', None),
+                                      get_file_unique_id(message), getattr(file_data, 'phash', None),
+                                      getattr(file_data, 'prefix_hash', None))
+        logger.info("Одиночные медиа отправлены одним альбомом: %s", len(batch))
+    except Exception as e:
+        error_msg = f"Ошибка отправки медиа: {str(e)}"
+        for message, _, _ in batch:
+            send_error_notification(message.chat.id, error_msg, message)
+    finally:
+        for message, file_data, claim in batch:
+            release_media_keys(get_message_media_keys(message, file_data), claim)
+            release_media_data(file_data)
+        finish_journaled_messages([message for message, _, _ in batch])
 
 def handle_single_message(message, file_id):
-    # Сначала проверяем file_id в базе данных
-    existing_message_id = check_media_by_file_id(file_id)
-    if existing_message_id:
+    # Сначала проверяем file_unique_id и file_id, не обращаясь к сети
+    existing_message_id = check_media_by_ids(message, file_id)
+    if existing_message_id is not None:
         bot.reply_to(message, f"⚠️ Это медиа уже было отправлено ранее (message_id: {existing_message_id})")
-        print(f"Дубликат медиа найден по file_id: {file_id}, message_id: {existing_message_id}")
+        logger.info("Дубликат медиа найден по file_unique_id/file_id: %s, message_id: %s", file_id, existing_message_id)
+        metrics.inc('tgbot_duplicates_total', 1, (('reason', 'file_id'),))
+        finish_journaled_messages([message])
         return
 
     def single_media_callback(data):
-        if not data:
-            send_error_notification(message.chat.id, "Не удалось скачать данные", message)
-            return
+        batched = False
+        try:
+            if not data:
+                send_error_notification(message.chat.id, "Не удалось скачать данные", message)
+                return
+
+            # Медиа из копящегося альбома держит резерв до отправки альбома, ждать его не нужно
+            if SINGLE_MEDIA_BATCH_WINDOW is not None and is_in_single_media_batch(message, data):
+                bot.reply_to(message, "⚠️ Это медиа уже ожидает отправки")
+                return
+
+            # Пока медиа проверяется и отправляется, такое же медиа в других потоках и процессах ждет
+            keys = get_message_media_keys(message, data)
+            claim = claim_media_keys(keys)
+            try:
+                batched = send_claimed_single_media(data, claim)
+            finally:
+                # Резерв медиа, попавшего в копящийся альбом, снимается после отправки альбома
+                if not batched:
+                    release_media_keys(keys, claim)
+        except Exception as e:
+            error_msg = f"Ошибка обработки медиа: {str(e)}"
+            send_error_notification(message.chat.id, error_msg, message)
+        finally:
+            # Медиа из копящегося альбома освобождается и завершается в журнале после отправки альбома
+            if not batched:
+                release_media_data(data)
+                finish_journaled_messages([message])
+
+    def send_claimed_single_media(data, claim):
+        """Проверяет и отправляет медиа под резервом; возвращает True, если медиа добавлено в копящийся альбом"""
+        # За время загрузки и ожидания резерва медиа могли отправить из другого процесса
+        existing_message_id = check_media_by_ids(message, file_id)
+        if existing_message_id is not None:
+            bot.reply_to(message, f"⚠️ Это медиа уже было отправлено ранее (message_id: {existing_message_id})")
+            logger.info("Дубликат медиа найден по file_unique_id/file_id: %s, message_id: %s", file_id, existing_message_id)
+            metrics.inc('tgbot_duplicates_total', 1, (('reason', 'file_id'),))
+            return False
 
-        # Если data это BytesIO (файл скачан), проверяем по хешу
+        # Если файл скачан (сейчас или до перезапуска), проверяем по хешу, посчитанному при загрузке
         file_hash = None
         file_size = None
-        if isinstance(data, io.BytesIO):
-            file_hash = calculate_file_hash(data)
-            file_size = get_file_size(message)
+        if isinstance(data, (DownloadedMedia, MediaFingerprint)) and data.data_hash:
+            file_hash = data.data_hash
+            file_size = data.size
 
             if file_hash:
                 # Проверяем по хешу
                 existing_message_id = check_media_by_hash(file_hash, file_size)
-                if existing_message_id:
+                if existing_message_id is not None:
                     bot.reply_to(message, f"⚠️ Это медиа уже было отправлено ранее (найдено по содержимому, message_id: {existing_message_id})")
-                    print(f"Дубликат медиа найден по хешу: {file_hash}, message_id: {existing_message_id}")
-                    return
+                    logger.info("Дубликат медиа найден по хешу: %s, message_id: %s",
+                                file_hash.hex(), existing_message_id)
+                    metrics.inc('tgbot_duplicates_total', 1, (('reason', 'hash'),))
+                    return False
+
+            # Проверяем фото на похожесть по перцептивному хешу
+            existing_message_id = check_media_by_phash(data.phash)
+            if existing_message_id is not None:
+                bot.reply_to(message, f"⚠️ Похожее изображение уже было отправлено ранее (message_id: {existing_message_id})")
+                logger.info("Похожее фото найдено по перцептивному хешу: %016x, message_id: %s",
+                            data.phash, existing_message_id)
+                metrics.inc('tgbot_duplicates_total', 1, (('reason', 'phash'),))
+                return False
+        elif isinstance(data, MediaFingerprint):
+            # Начало файла не совпало ни с одним медиа в БД, значит медиа новое
+            file_size = data.size
 
-        # Медиа не является дубликатом, отправляем его
+        # Медиа не является дубликатом, при включенном объединении добавляем его в копящийся альбом
+        if SINGLE_MEDIA_BATCH_WINDOW is not None and get_media_type(message) in MEDIA_GROUP_KINDS:
+            add_to_single_media_batch(message, data, claim)
+            return True
+
+        # Отправляем медиа отдельно
         try:
-            media_list = []
-            media_list.append(create_input_media(message, data))
-            sent_messages = bot.send_media_group(TARGET_CHAT_ID, media=media_list)
+            sent_messages = send_media_items([(message, data)])
 
             if sent_messages and len(sent_messages) > 0:
                 # Добавляем в базу данных
-                add_media_to_database(file_id, sent_messages[0].message_id, file_hash, file_size)
-                print(f"Медиа из сообщения {message.message_id} отправлено, новый message_id: {sent_messages[0].message_id}")
+                add_media_to_database(file_id, sent_messages[0].message_id, file_hash, file_size,
+                                      get_file_unique_id(message), getattr(data, 'phash', None),
+                                      getattr(data, 'prefix_hash', None))
+                logger.info("Медиа из сообщения %s отправлено, новый message_id: %s",
+                            message.message_id, sent_messages[0].message_id)
         except Exception as e:
             error_msg = f"Ошибка отправки медиа: {str(e)}"
             send_error_notification(message.chat.id, error_msg, message)
+        return False
+
+    def process_single_media(data):
+        # Отправка может ждать в очереди чата, поэтому выполняется в пуле отправки,
+        # а не в потоке загрузки или обработки обновлений
+        send_executor.submit(single_media_callback, data)
 
     # print("Обработка одиночного медиа...")
+    if not should_hash_media(message):
+        logger.debug("Медиа из сообщения %s не хешируется по политике, будет отправлено по ID", message.message_id)
+        process_single_media(file_id)
+        return
+    reserved_bytes = reserve_download_memory(message)
+    if reserved_bytes is None:
+        logger.warning("Бюджет памяти исчерпан, медиа из сообщения %s будет отправлено по ID без проверки содержимого",
+                       message.message_id)
+        process_single_media(file_id)
+        return
     try:
         # print("Попытка загрузки...")
-        file_info = bot.get_file(file_id)
-        download_media_file_async(file_info, single_media_callback)
-        print(f"Начата загрузка медиа для сообщения {message.message_id}")
+        start_media_download(file_id, process_single_media, compute_phash=bool(message.photo),
+                             reserved_bytes=reserved_bytes)
+        logger.debug("Начата загрузка медиа для сообщения %s", message.message_id)
     except Exception as e:
         # print("Попытка загрузки не удалась: " + str(e))
+        memory_budget.release(reserved_bytes)
         if "file is too big" in str(e).lower():
-            single_media_callback(file_id)
-            print(f"Файл слишком большой, медиа из сообщения {message.message_id} будет отправлено по ID")
+            process_single_media(file_id)
+            logger.info("Файл слишком большой, медиа из сообщения %s будет отправлено по ID", message.message_id)
+        else:
+            finish_journaled_messages([message])
 
 def handle_message(message):
-    print("Обработка медиа...")
+    logger.debug("Обработка медиа...")
     if message.media_group_id is None:
         # Одиночное медиа
         try:
@@ -419,12 +2641,16 @@ def handle_message(message):
         except Exception as e:
             error_msg = f"Ошибка обработки одиночного медиа:\n{str(e)}"
             send_error_notification(message.chat.id, error_msg, message)
+            finish_journaled_messages([message])
     else:
         # Медиа в группе
         media_group_id = message.media_group_id
         try:
             with media_groups_lock:
                 media_groups_downloading[media_group_id] += 1
+                media_groups_started.setdefault(media_group_id, time.perf_counter())
+                # Новое медиа продлевает ожидание альбома
+                media_groups_ready.discard(media_group_id)
             if message.photo:
                 file_id = message.photo[-1].file_id
                 handle_message_from_media_group(message, media_group_id, file_id)
@@ -440,51 +2666,388 @@ def handle_message(message):
             elif message.audio:
                 file_id = message.audio.file_id
                 handle_message_from_media_group(message, media_group_id, file_id)
-            # Планируем отправку через 3 секунды
-            schedule_media_group_send(media_group_id, delay=3.0)
+            # Планируем отправку после паузы в поступлении медиа
+            schedule_media_group_send(media_group_id)
         except Exception as e:
             error_msg = f"Ошибка обработки медиа для группы {media_group_id}:\n{str(e)}"
             send_error_notification(message.chat.id, error_msg, message)
             with media_groups_lock:
-                media_groups_downloading[media_group_id] -= 1
+                finish_media_group_download(media_group_id)
+
+# ==================== Прием обновлений ====================
+
+# Обновления из long polling или вебхука попадают в ограниченную очередь,
+# которую разбирает пул обработчиков
+UPDATE_QUEUE_SIZE = 1000
+UPDATE_WORKERS = 8
+UPDATE_ENQUEUE_TIMEOUT = 5.0  # Сколько вебхук ждет места в очереди, прежде чем ответить 503
+POLLING_TIMEOUT = 30  # Таймаут long polling, в секундах
+
+update_queue = queue.Queue(maxsize=UPDATE_QUEUE_SIZE)
+update_partitions = []  # Очереди процессов-обработчиков, если обновления обрабатываются в нескольких процессах
+partition_journals = []  # Журналы процессов-обработчиков, открытые в основном процессе для записи обновлений
+
+def enqueue_update(update, timeout=None):
+    """
+    Ставит обновление в очередь обработки, при заполненной очереди ждет до timeout секунд
+    При работе с процессами-обработчиками обновление передается процессу своей части
+    и записывается в журнал этого процесса
+    Возвращает False, если место так и не освободилось
+    """
+    if update_partitions:
+        partition = get_update_partition(update, len(update_partitions))
+        target_journal = partition_journals[partition] if partition_journals else None
+        return put_journaled_update(target_journal, update_partitions[partition], update, update, timeout)
+    return put_journaled_update(journal, update_queue, (time.perf_counter(), update), update, timeout)
+
+def put_journaled_update(target_journal, target_queue, item, update, timeout):
+    """
+    Записывает обновление в журнал и ставит item в очередь
+    Обновление попадает в журнал до подтверждения Telegram; уже записанное (повторная доставка) пропускается
+    """
+    if target_journal is not None and not target_journal.record_update(update):
+        logger.debug("Обновление %s уже есть в журнале", update.update_id)
+        return True
+    try:
+        target_queue.put(item, timeout=timeout)
+        return True
+    except queue.Full:
+        # Telegram доставит обновление повторно, до тех пор оно не должно числиться в журнале
+        if target_journal is not None:
+            target_journal.discard_update(update.update_id)
+        return False
+
+def get_update_partition(update, partitions):
+    """
+    Возвращает номер процесса-обработчика для обновления
+    Все части альбома попадают в один процесс, одиночные сообщения распределяются по update_id
+    """
+    message = update.message or update.channel_post
+    if message is not None and message.media_group_id:
+        return zlib.crc32(message.media_group_id.encode()) % partitions
+    return update.update_id % partitions
+
+def update_worker():
+    """Обработчик очереди обновлений: передает обновления зарегистрированным хендлерам бота"""
+    while True:
+        enqueued, update = update_queue.get()
+        observe_stage('ingest_wait', time.perf_counter() - enqueued)
+        try:
+            with measure_stage('ingest'):
+                bot.process_new_updates([update])
+        except Exception as e:
+            logger.error("Ошибка обработки обновления %s: %s", update.update_id, e)
+        finally:
+            update_queue.task_done()
+
+def start_update_workers():
+    """Запускает пул обработчиков обновлений"""
+    for i in range(UPDATE_WORKERS):
+        threading.Thread(target=update_worker, name=f"update-worker-{i}", daemon=True).start()
+
+# ==================== Процессы-обработчики ====================
+
+def set_api_url(api_url):
+    """Направляет запросы к Bot API на указанный сервер"""
+    global TELEGRAM_API_URL
+    TELEGRAM_API_URL = api_url.rstrip('/')
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + '/bot{0}/{1}'
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL + '/file/bot{0}/{1}'
+
+def get_worker_journal_path(path, index):
+    """Возвращает путь к журналу процесса-обработчика с номером index"""
+    root, ext = os.path.splitext(path)
+    return f"{root}-{index + 1}{ext}"
+
+def run_worker_process(index, partition_queue, ready, settings):
+    """
+    Процесс-обработчик своей части обновлений
+    Процессы делят хранилище дедупликации и резервируют в нем медиа перед отправкой,
+    лимит отправки в чат и бюджет памяти делятся между процессами поровну.
+    У каждого процесса свой журнал: при том же числе процессов альбомы попадают в тот же процесс.
+    Обновления в журнал записывает основной процесс до подтверждения Telegram, поэтому
+    обновления из очереди процесса в журнал повторно не пишутся. ready устанавливается после
+    восстановления работы из журнала, до этого основной процесс не принимает новые обновления
+    """
+    global bot, TARGET_CHAT_ID, SEND_RATE_PER_MINUTE, memory_budget, dedup_store
+    setup_logging(settings['log_level'])
+    workers = settings['workers']
+    if settings['api_url'] != TELEGRAM_API_URL:
+        set_api_url(settings['api_url'])
+    bot = create_bot(settings['api_token'])
+    TARGET_CHAT_ID = settings['target_chat_id']
+    SEND_RATE_PER_MINUTE = SEND_RATE_PER_MINUTE / workers
+    memory_budget = MemoryBudget(MEMORY_BUDGET_BYTES // workers)
+    dedup_store = create_dedup_store(settings['dedup_url'], shared=True)
+    dedup_store.open()
+
+    start_update_workers()
+    if settings['journal_path']:
+        open_journal(get_worker_journal_path(settings['journal_path'], index))
+    ready.set()
+    if settings['metrics_listen']:
+        # Каждый процесс отдает свои метрики на следующем порту после основного
+        host, _, port = settings['metrics_listen'].rpartition(':')
+        start_metrics_server(f"{host}:{int(port) + index + 1}")
+    logger.info("Процесс-обработчик %s из %s запущен", index + 1, workers)
+
+    try:
+        while True:
+            update = partition_queue.get()
+            if update is None:
+                break
+            while True:
+                try:
+                    update_queue.put((time.perf_counter(), update), timeout=UPDATE_ENQUEUE_TIMEOUT)
+                    break
+                except queue.Full:
+                    logger.warning("Очередь обработки процесса %s заполнена", index + 1)
+        update_queue.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_journal()
+        dedup_store.close()
+        stop_logging()
+
+def start_worker_processes(workers, settings):
+    """
+    Запускает процессы-обработчики и направляет в них поток обновлений
+    Возвращается после того, как каждый процесс восстановил работу из своего журнала
+    """
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for index in range(workers):
+        partition_queue = context.Queue(maxsize=UPDATE_QUEUE_SIZE)
+        ready = context.Event()
+        process = context.Process(target=run_worker_process, args=(index, partition_queue, ready, settings),
+                                  name=f"update-process-{index}")
+        process.start()
+        update_partitions.append(partition_queue)
+        processes.append((process, ready))
+
+    for index, (process, ready) in enumerate(processes):
+        while not ready.wait(1):
+            if not process.is_alive():
+                raise RuntimeError(f"Процесс-обработчик {index + 1} завершился при запуске")
+        if settings['journal_path']:
+            partition_journals.append(WorkJournal(get_worker_journal_path(settings['journal_path'], index)))
+    return [process for process, _ in processes]
+
+def stop_worker_processes(processes):
+    """Останавливает процессы-обработчики после обработки принятых обновлений"""
+    for partition_queue in update_partitions:
+        partition_queue.put(None)
+    for process in processes:
+        process.join()
+    for partition_journal in partition_journals:
+        partition_journal.close()
+
+def run_polling():
+    """
+    Получает обновления через long polling
+    Смещение (offset) сдвигается только после того, как обновление поставлено в очередь,
+    поэтому Telegram не считает обновление доставленным, пока оно не принято в обработку.
+    Если очередь заполнена, прием новых обновлений приостанавливается
+    """
+    bot.remove_webhook()
+    offset = None
+    while True:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT, long_polling_timeout=POLLING_TIMEOUT)
+        except Exception as e:
+            logger.error("Ошибка получения обновлений: %s", e)
+            time.sleep(1)
+            continue
+        for update in updates:
+            enqueue_update(update)
+            offset = update.update_id + 1
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Принимает обновления от Telegram по HTTP
+    Ответ 200 отправляется только после постановки обновления в очередь, при заполненной
+    очереди возвращается 503, и Telegram повторит доставку позже
+    """
+    webhook_path = '/'
+    secret_token = None
+
+    def do_POST(self):
+        if urlparse(self.path).path != self.webhook_path:
+            self.send_error(404)
+            return
+        if self.secret_token and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            update = types.Update.de_json(json.loads(self.rfile.read(length)))
+        except Exception as e:
+            logger.error("Некорректное обновление вебхука: %s", e)
+            self.send_error(400)
+            return
+        if not enqueue_update(update, timeout=UPDATE_ENQUEUE_TIMEOUT):
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def run_webhook(webhook_url, listen, secret_token=None):
+    """
+    Регистрирует вебхук и принимает обновления локальным HTTP-сервером
+    TLS обычно завершается на обратном прокси перед сервером
+    """
+    host, _, port = listen.rpartition(':')
+    WebhookHandler.webhook_path = urlparse(webhook_url).path or '/'
+    WebhookHandler.secret_token = secret_token
+    server = ThreadingHTTPServer((host or '0.0.0.0', int(port)), WebhookHandler)
+    bot.remove_webhook()
+    bot.set_webhook(url=webhook_url, secret_token=secret_token, max_connections=UPDATE_WORKERS)
+    logger.info("Вебхук %s принимает обновления на %s", webhook_url, listen)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+# ==================== Экспорт метрик ====================
+
+metrics.describe('tgbot_update_queue_size', 'gauge', "Обновлений в очереди обработки")
+metrics.describe('tgbot_db_write_queue_size', 'gauge', "Записей в очереди потока-писателя БД")
+metrics.describe('tgbot_pending_media', 'gauge', "Медиа, ожидающих записи в БД")
+metrics.describe('tgbot_download_concurrency_limit', 'gauge', "Текущий предел одновременных загрузок")
+metrics.describe('tgbot_memory_budget_used_bytes', 'gauge', "Занятый бюджет памяти под медиа")
+metrics.describe('tgbot_memory_budget_peak_bytes', 'gauge', "Пик занятого бюджета памяти под медиа")
+metrics.describe('tgbot_memory_budget_rejected', 'gauge', "Загрузок, не поместившихся в бюджет памяти")
+
+def collect_gauges():
+    """Возвращает текущие значения очередей и ресурсов для экспорта метрик"""
+    return [
+        ('tgbot_update_queue_size', update_queue.qsize()),
+        ('tgbot_db_write_queue_size', db_write_queue.qsize()),
+        ('tgbot_pending_media', len(pending_media)),
+        ('tgbot_download_concurrency_limit', download_limiter.limit),
+        ('tgbot_memory_budget_used_bytes', memory_budget.used),
+        ('tgbot_memory_budget_peak_bytes', memory_budget.peak),
+        ('tgbot_memory_budget_rejected', memory_budget.rejected),
+    ]
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Отдает метрики в текстовом формате Prometheus по адресу /metrics"""
+    def do_GET(self):
+        if urlparse(self.path).path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render(collect_gauges()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(listen):
+    """Запускает HTTP-сервер метрик в фоновом потоке"""
+    host, _, port = listen.rpartition(':')
+    server = ThreadingHTTPServer((host or '0.0.0.0', int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info("Метрики доступны на http://%s/metrics", listen)
+    return server
 
 def send_chat_id(message):
     chat_id = message.chat.id
     bot.reply_to(message, f"ID этого чата: `{chat_id}`", parse_mode="Markdown")
 
-def create_bot():
+def send_status(message):
+    bot.reply_to(message, get_memory_status())
+
+def create_bot(api_token=None):
+    """Создает бота и регистрирует обработчики; без api_token токен читается из API_TOKEN.txt"""
     global API_TOKEN
-    with open('API_TOKEN.txt', 'r') as f:
-        API_TOKEN = f.read().strip()
-    bot = telebot.TeleBot(API_TOKEN)
+    if api_token is None:
+        with open('API_TOKEN.txt', 'r') as f:
+            api_token = f.read().strip()
+    API_TOKEN = api_token
+    # Хендлеры выполняются в пуле update_worker, поэтому собственные потоки telebot не нужны
+    bot = telebot.TeleBot(API_TOKEN, threaded=False)
 
     # Регистрируем все обработчики после создания бота
     bot.message_handler(content_types=['photo', 'video', 'animation', 'document', 'audio'])(handle_message)
     bot.message_handler(commands=['get_chat_id'])(send_chat_id)
+    bot.message_handler(commands=['status'])(send_status)
     return bot
 
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Бот для пересылки медиа без дубликатов")
+    parser.add_argument('--webhook-url', help="Публичный URL вебхука (без него используется long polling)")
+    parser.add_argument('--listen', default='0.0.0.0:8443', help="Адрес локального HTTP-сервера вебхука")
+    parser.add_argument('--webhook-secret', help="Секрет для заголовка X-Telegram-Bot-Api-Secret-Token")
+    parser.add_argument('--api-url', default=TELEGRAM_API_URL, help="Адрес сервера Bot API")
+    parser.add_argument('--metrics-listen', help="Адрес HTTP-сервера метрик Prometheus, например 127.0.0.1:9100")
+    parser.add_argument('--log-level', default='INFO', help="Уровень журнала (DEBUG, INFO, WARNING, ERROR)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Количество процессов-обработчиков; альбомы распределяются по ним по media_group_id")
+    parser.add_argument('--dedup-url', help="Адрес сетевого хранилища дедупликации (dedup_server.py), "
+                                            "общего для нескольких экземпляров бота")
+    parser.add_argument('--journal', default=JOURNAL_PATH,
+                        help="Путь к журналу незавершенной работы (пустая строка отключает журнал)")
+    return parser.parse_args()
+
 if __name__ == '__main__':
+    args = parse_arguments()
+    setup_logging(args.log_level.upper())
+    if args.api_url != TELEGRAM_API_URL:
+        set_api_url(args.api_url)
+
     bot = create_bot()
 
     with open('TARGET_CHAT_ID.txt', 'r') as f:
         TARGET_CHAT_ID = f.read().strip()
 
-    # Инициализируем базу данных для дедупликации медиа
-    init_database()
+    logger.info("Бот запущен, API_TOKEN = %s, TARGET_CHAT_ID = %s", API_TOKEN, TARGET_CHAT_ID)
 
-    print(f"Бот запущен, API_TOKEN = {API_TOKEN}, TARGET_CHAT_ID = {TARGET_CHAT_ID}")
+    worker_processes = []
+    if args.workers > 1:
+        # Основной процесс только распределяет обновления, хранилище открывают процессы-обработчики
+        worker_processes = start_worker_processes(args.workers, {
+            'api_token': API_TOKEN,
+            'target_chat_id': TARGET_CHAT_ID,
+            'api_url': TELEGRAM_API_URL,
+            'dedup_url': args.dedup_url,
+            'log_level': args.log_level.upper(),
+            'metrics_listen': args.metrics_listen,
+            'workers': args.workers,
+            'journal_path': args.journal,
+        })
+    else:
+        # Открываем хранилище для дедупликации медиа (локальную БД или сетевое хранилище)
+        dedup_store = create_dedup_store(args.dedup_url)
+        dedup_store.open()
+        start_update_workers()
+        # Работа, прерванная прошлым запуском, продолжается до приема новых обновлений
+        if args.journal:
+            open_journal(args.journal)
+    if args.metrics_listen:
+        start_metrics_server(args.metrics_listen)
 
     try:
-        bot.polling(none_stop=True)
+        if args.webhook_url:
+            run_webhook(args.webhook_url, args.listen, args.webhook_secret)
+        else:
+            run_polling()
     except KeyboardInterrupt:
-        print("Остановка бота...")
-        download_executor.shutdown(wait=False)
-        if db_connection:
-            db_connection.close()
-            print("Соединение с базой данных закрыто")
+        logger.info("Остановка бота...")
     except Exception as e:
-        print(f"Критическая ошибка: {e}")
+        logger.error("Критическая ошибка: %s", e)
+    finally:
+        stop_worker_processes(worker_processes)
         download_executor.shutdown(wait=False)
-        if db_connection:
-            db_connection.close()
-            print("Соединение с базой данных закрыто")
+        send_executor.shutdown(wait=False)
+        close_journal()
+        dedup_store.close()
+        stop_logging()
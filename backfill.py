@@ -0,0 +1,213 @@
+"""
+Заполнение базы дедупликации медиа, которые уже есть в целевом чате
+
+Источник - экспорт чата из Telegram Desktop (папка с result.json) или папка с медиафайлами.
+Файлы хешируются в пуле процессов (SHA256 через mmap, отпечаток начала для крупных файлов,
+перцептивный хеш для фотографий при наличии Pillow) и загружаются в media_files большими
+транзакциями. Загрузку можно прервать и запустить снова: уже записанные файлы пропускаются.
+
+В экспорте нет file_id и file_unique_id, поэтому записи получают служебный file_id
+"backfill:<путь файла>" и находятся ботом по хешу содержимого. Файлы, для которых
+не удалось определить message_id, пропускаются: без него бот не сможет сослаться
+на уже отправленное сообщение.
+
+Примеры:
+    python backfill.py --export ~/Downloads/Telegram\\ Desktop/ChatExport_2024-01-01
+    python backfill.py --media-dir ./media --message-id-regex "(\\d+)"
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import time
+
+import Bot
+
+BACKFILL_FILE_ID_PREFIX = 'backfill:'
+BACKFILL_BATCH_SIZE = 20000  # Записей в одной транзакции
+BACKFILL_CHUNK_SIZE = 64  # Файлов, которые процесс пула получает за раз
+PROGRESS_INTERVAL = 5.0  # Период вывода прогресса, в секундах
+PHOTO_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+
+# Файлы, не выгруженные Telegram Desktop, указаны в экспорте текстом в скобках
+EXPORT_MISSING_FILE_PREFIX = '('
+
+logger = logging.getLogger('tgbot.backfill')
+
+
+def iter_export_media(export_path, chat_id=None):
+    """
+    Перебирает медиа из экспорта Telegram Desktop
+    Возвращает (путь к файлу, message_id, является ли фотографией)
+    Экспорт всего аккаунта содержит несколько чатов, chat_id выбирает один из них
+    """
+    if os.path.isdir(export_path):
+        export_path = os.path.join(export_path, 'result.json')
+    export_dir = os.path.dirname(os.path.abspath(export_path))
+    with open(export_path, encoding='utf-8') as f:
+        export = json.load(f)
+
+    if 'messages' in export:
+        chats = [export]
+    else:
+        chats = export.get('chats', {}).get('list', [])
+    for chat in chats:
+        if chat_id is not None and str(chat.get('id')) not in (str(chat_id), str(chat_id).removeprefix('-100')):
+            continue
+        for message in chat.get('messages', []):
+            if message.get('type') != 'message':
+                continue
+            for key, is_photo in (('photo', True), ('file', False)):
+                relative_path = message.get(key)
+                if relative_path and not relative_path.startswith(EXPORT_MISSING_FILE_PREFIX):
+                    yield os.path.join(export_dir, relative_path), message['id'], is_photo
+
+
+def iter_directory_media(media_dir, message_id_regex=None):
+    """
+    Перебирает файлы папки с медиа
+    message_id берется из имени файла по первой группе message_id_regex, иначе равен None
+    """
+    pattern = re.compile(message_id_regex) if message_id_regex else None
+    for root, _, file_names in os.walk(media_dir):
+        for file_name in sorted(file_names):
+            message_id = None
+            if pattern:
+                match = pattern.search(file_name)
+                if match:
+                    message_id = int(match.group(1))
+            is_photo = os.path.splitext(file_name)[1].lower() in PHOTO_EXTENSIONS
+            yield os.path.join(root, file_name), message_id, is_photo
+
+
+def hash_media_file(task):
+    """
+    Считает хеши одного файла (выполняется в процессе пула)
+    Возвращает (file_id, message_id, data_hash, file_size, phash, prefix_hash, ошибка)
+    Ошибка возвращается текстом: журнал процесса пула не выводится
+    """
+    file_id, path, message_id, is_photo = task
+    try:
+        with open(path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            prefix_hash = None
+            if file_size == 0:
+                data_hash = hashlib.sha256().digest()
+            else:
+                # mmap позволяет хешировать файл без копирования в память процесса
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    data_hash = hashlib.sha256(mapped).digest()
+                    if file_size >= Bot.PREFIX_MIN_FILE_SIZE:
+                        prefix_hash = hashlib.sha256(mapped[:Bot.PREFIX_FINGERPRINT_BYTES]).digest()
+            phash = Bot.calculate_perceptual_hash(f) if is_photo else None
+        return file_id, message_id, data_hash, file_size, phash, prefix_hash, None
+    except (OSError, ValueError) as e:
+        return file_id, message_id, None, None, None, None, f"{path}: {e}"
+
+
+def load_backfilled_file_ids():
+    """Возвращает служебные file_id, уже записанные предыдущими запусками"""
+    # Диапазон по первичному ключу: ';' следует за ':' в таблице символов
+    cursor = Bot.db_connection.execute('SELECT file_id FROM media_files WHERE file_id >= ? AND file_id < ?',
+                                       (BACKFILL_FILE_ID_PREFIX, 'backfill;'))
+    return {file_id for file_id, in cursor}
+
+
+def run_backfill(media, source_root, workers, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Хеширует медиа в пуле процессов и пачками записывает их в базу
+    media - перебор (путь, message_id, является ли фотографией)
+    Возвращает (записано, пропущено как уже записанные, без message_id, ошибок)
+    """
+    done_file_ids = load_backfilled_file_ids()
+    skipped = 0
+    without_message_id = 0
+
+    def tasks():
+        nonlocal skipped, without_message_id
+        for path, message_id, is_photo in media:
+            if not message_id:
+                without_message_id += 1
+                continue
+            file_id = BACKFILL_FILE_ID_PREFIX + os.path.relpath(path, source_root).replace(os.sep, '/')
+            if file_id in done_file_ids:
+                skipped += 1
+                continue
+            yield file_id, path, message_id, is_photo
+
+    written = 0
+    errors = 0
+    rows = []
+    started = last_progress = time.monotonic()
+    # Процессы запускаются через spawn и не наследуют потоки и соединение с базой
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        for result in pool.imap_unordered(hash_media_file, tasks(), chunksize=BACKFILL_CHUNK_SIZE):
+            file_id, message_id, data_hash, file_size, phash, prefix_hash, error = result
+            if error:
+                logger.error("Не удалось прочитать %s", error)
+                errors += 1
+                continue
+            rows.append((file_id, message_id, data_hash, file_size, None, phash, prefix_hash))
+            if len(rows) >= batch_size:
+                written, errors = write_rows(rows, written, errors)
+                rows = []
+            if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                processed = written + len(rows)
+                logger.info("Обработано %s файлов (%.0f файлов/с), пропущено %s, ошибок %s",
+                            processed, processed / (last_progress - started), skipped, errors)
+    if rows:
+        written, errors = write_rows(rows, written, errors)
+    if without_message_id:
+        logger.warning("Пропущено файлов без message_id: %s (для --media-dir укажите --message-id-regex)",
+                       without_message_id)
+    return written, skipped, without_message_id, errors
+
+
+def write_rows(rows, written, errors):
+    """Записывает пачку в базу и возвращает обновленные счетчики (записано, ошибок)"""
+    if Bot.write_media_batch(rows):
+        return written + len(rows), errors
+    return written, errors + len(rows)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Заполнение базы дедупликации медиа из экспорта или папки")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--export', help="Папка экспорта Telegram Desktop (или ее result.json)")
+    source.add_argument('--media-dir', help="Папка с медиафайлами")
+    parser.add_argument('--export-chat-id', help="Чат из экспорта всего аккаунта, который нужно загрузить")
+    parser.add_argument('--message-id-regex', help="Регулярное выражение для message_id в имени файла (--media-dir)")
+    parser.add_argument('--database', default=Bot.DATABASE_PATH, help="Путь к базе дедупликации")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Количество процессов хеширования")
+    parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE, help="Записей в одной транзакции")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    Bot.setup_logging()
+    Bot.DATABASE_PATH = args.database
+
+    if args.export:
+        source_root = os.path.dirname(os.path.abspath(args.export)) if args.export.endswith('.json') else args.export
+        media = iter_export_media(args.export, args.export_chat_id)
+    else:
+        source_root = args.media_dir
+        media = iter_directory_media(args.media_dir, args.message_id_regex)
+
+    started = time.monotonic()
+    Bot.init_database()
+    try:
+        written, skipped, without_message_id, errors = run_backfill(media, source_root, args.workers, args.batch_size)
+    finally:
+        Bot.close_database()
+    elapsed = time.monotonic() - started
+    logger.info("Готово за %.1f с: записано %s, уже были в базе %s, без message_id %s, ошибок %s",
+                elapsed, written, skipped, without_message_id, errors)
+    Bot.stop_logging()
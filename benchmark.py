@@ -0,0 +1,443 @@
+"""
+Нагрузочный тест бота на локальной замене Bot API (fake_bot_api.py)
+
+Сервер Bot API запускается в отдельном процессе, бот - в процессе теста, поэтому пиковая
+память (RSS) относится только к боту. Синтетическая нагрузка подается через обычный прием
+обновлений бота (очередь обновлений, long polling или вебхук) и проходит через handle_message.
+
+Для каждой нагрузки выводятся пропускная способность, задержка от поступления сообщения
+до отправки альбома или ответа о дубликате (p50/p99), пиковый RSS и размер БД.
+С --baseline результаты сравниваются с сохраненными ранее (--json), и при ухудшении
+больше допустимого тест завершается с кодом 1.
+
+Примеры:
+    python benchmark.py
+    python benchmark.py --workload big_videos --bandwidth 20000000 --json results.json
+    python benchmark.py --ingest webhook --error-429-rate 0.1 --baseline results.json
+"""
+
+import argparse
+import ast
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import fake_bot_api
+
+BENCHMARK_TOKEN = '1:benchmark'
+SOURCE_CHAT_ID = -1001
+TARGET_CHAT_ID = -1002
+
+# Настройки бота на время теста: лимит отправки Telegram (20 в минуту) растянул бы
+# каждую нагрузку на десятки минут, его можно вернуть через --set
+BOT_SETTINGS = {
+    'SEND_RATE_PER_MINUTE': 1200,
+    'SEND_BURST': 20,
+}
+
+SETTLE_SECONDS = 3.0  # Сколько ждать новых отправок, прежде чем считать прогон завершенным
+EVENTS_POLL_INTERVAL = 0.5
+
+
+# ==================== Нагрузки ====================
+
+class Workload:
+    """
+    Синтетическая нагрузка: файлы для сервера и расписание сообщений
+    Элемент расписания - (смещение от начала в секундах, список сообщений одного альбома
+    или одно одиночное сообщение)
+    """
+    def __init__(self, name, seed):
+        self.name = name
+        self.random = random.Random(seed)
+        self.files = {}  # file_id -> описание для fake_bot_api
+        self.schedule = []
+        self.seen_contents = set()
+        self.duplicate_file_ids = set()  # file_id, содержимое которых уже встречалось раньше
+        self.message_ids = iter(range(1, 1 << 62))
+        self.file_ids = iter(range(1, 1 << 62))
+
+    def media(self, kind, size, duplicate_rate):
+        """Создает описание медиа: с вероятностью duplicate_rate повторяет уже отправленное содержимое"""
+        file_id = f'{kind}{next(self.file_ids)}'
+        seen = sorted(content for content in self.seen_contents if content.startswith(f'{kind}:'))
+        if seen and self.random.random() < duplicate_rate:
+            content = self.random.choice(seen)
+            size = self.files[content.split(':', 1)[1]]['size']
+            self.duplicate_file_ids.add(file_id)
+            # Пересланные медиа сохраняют file_unique_id, загруженные заново получают новый
+            unique_id = f'u{content}' if self.random.random() < 0.5 else f'u{file_id}'
+        else:
+            content = f'{kind}:{file_id}'
+            unique_id = f'u{content}'
+        self.files[file_id] = {'content': content, 'size': size, 'kind': kind}
+        return kind, {'file_id': file_id, 'file_unique_id': unique_id, 'file_size': size}
+
+    def add_item(self, offset, media_list):
+        """Добавляет в расписание альбом (если медиа несколько) или одиночное сообщение"""
+        media_group_id = f'album{len(self.schedule)}' if len(media_list) > 1 else None
+        messages = []
+        for kind, media in media_list:
+            message = {
+                'message_id': next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': SOURCE_CHAT_ID, 'type': 'supergroup'},
+                'from': {'id': 7, 'is_bot': False, 'first_name': 'benchmark'},
+            }
+            if media_group_id:
+                message['media_group_id'] = media_group_id
+            if kind == 'photo':
+                message['photo'] = [dict(media, width=640, height=480)]
+            elif kind == 'video':
+                message['video'] = dict(media, width=1280, height=720, duration=10)
+            else:
+                message[kind] = media
+            messages.append(message)
+        # Содержимое считается увиденным после постановки всего элемента в расписание
+        for kind, media in media_list:
+            self.seen_contents.add(self.files[media['file_id']]['content'])
+        self.schedule.append((offset, messages))
+
+
+def bursty_albums(scale, seed):
+    """Пачки альбомов по 2-10 фотографий, приходящие одновременно; 20% фотографий - повторы"""
+    workload = Workload('bursty_albums', seed)
+    for burst in range(max(1, int(5 * scale))):
+        for _ in range(10):
+            size = workload.random.randint(2, 10)
+            workload.add_item(burst * 3.0, [workload.media('photo', 60 * 1024, 0.2) for _ in range(size)])
+    return workload
+
+
+def big_videos(scale, seed):
+    """Крупные видео от 2 до 30 МБ (часть больше лимита getFile); 30% - повторы"""
+    workload = Workload('big_videos', seed)
+    for i in range(max(1, int(20 * scale))):
+        size = workload.random.randint(2, 30) * 1024 * 1024
+        workload.add_item(i * 0.5, [workload.media('video', size, 0.3)])
+    return workload
+
+
+def duplicate_stream(scale, seed):
+    """Плотный поток одиночных фото и документов, 80% из которых - повторы"""
+    workload = Workload('duplicate_stream', seed)
+    for i in range(max(1, int(300 * scale))):
+        kind = 'photo' if workload.random.random() < 0.7 else 'document'
+        size = 60 * 1024 if kind == 'photo' else workload.random.randint(10, 500) * 1024
+        workload.add_item(i * 0.02, [workload.media(kind, size, 0.8)])
+    return workload
+
+
+WORKLOADS = {
+    'bursty_albums': bursty_albums,
+    'big_videos': big_videos,
+    'duplicate_stream': duplicate_stream,
+}
+
+
+# ==================== Запуск ====================
+
+def control_request(api_url, path, payload=None):
+    """Вызывает служебный адрес fake_bot_api"""
+    data = json.dumps(payload).encode() if payload is not None else None
+    request = urllib.request.Request(f'{api_url}/control/{path}', data=data, method='POST' if data else 'GET',
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read()).get('result')
+
+
+def find_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def parse_setting(text):
+    """Разбирает NAME=VALUE, значение - литерал Python или строка"""
+    name, _, value = text.partition('=')
+    try:
+        return name, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return name, value
+
+
+def start_bot(api_url, ingest, settings, workdir, log_level):
+    """Настраивает модуль бота на локальный сервер и запускает прием обновлений"""
+    import telebot
+    import Bot
+
+    Bot.TELEGRAM_API_URL = api_url
+    telebot.apihelper.API_URL = api_url + '/bot{0}/{1}'
+    telebot.apihelper.FILE_URL = api_url + '/file/bot{0}/{1}'
+    Bot.DATABASE_PATH = os.path.join(workdir, 'media_deduplication.db')
+    Bot.ARCHIVE_DATABASE_PATH = os.path.join(workdir, 'media_deduplication_archive.db')
+    for name, value in settings.items():
+        if not hasattr(Bot, name):
+            raise ValueError(f"В модуле бота нет настройки {name}")
+        setattr(Bot, name, value)
+    Bot.memory_budget.limit = Bot.MEMORY_BUDGET_BYTES
+
+    Bot.setup_logging(log_level)
+    Bot.bot = Bot.create_bot(BENCHMARK_TOKEN)
+    Bot.TARGET_CHAT_ID = str(TARGET_CHAT_ID)
+    Bot.init_database()
+    Bot.start_update_workers()
+
+    if ingest == 'polling':
+        threading.Thread(target=Bot.run_polling, name="benchmark-polling", daemon=True).start()
+    elif ingest == 'webhook':
+        port = find_free_port()
+        webhook_url = f'http://127.0.0.1:{port}/webhook'
+        threading.Thread(target=Bot.run_webhook, args=(webhook_url, f'127.0.0.1:{port}', 'benchmark-secret'),
+                         name="benchmark-webhook", daemon=True).start()
+        while not (control_request(api_url, 'stats') or {}).get('method_setWebhook'):
+            time.sleep(0.1)
+    return Bot
+
+
+def inject_messages(Bot, api_url, ingest, messages, update_ids):
+    """Подает сообщения боту выбранным способом приема обновлений"""
+    updates = [{'update_id': next(update_ids), 'message': message} for message in messages]
+    if ingest == 'queue':
+        for update in updates:
+            Bot.enqueue_update(Bot.types.Update.de_json(update))
+    else:
+        control_request(api_url, 'updates', updates)
+
+
+def resolve_items(workload, inject_times, events, lenient):
+    """
+    Определяет время обработки каждого элемента нагрузки по отправкам бота
+    Медиа считается обработанным, когда его file_id отправлен в целевой чат или (для повтора)
+    бот ответил на сообщение элемента. С lenient ответ засчитывается для всех медиа элемента -
+    так учитываются повторы, которые бот обработал в другом порядке, чем в расписании
+    Возвращает список задержек (None для необработанных элементов)
+    """
+    sent_at = {}
+    replied_at = {}
+    item_by_message = {}
+    for index, (_, messages) in enumerate(workload.schedule):
+        for message in messages:
+            item_by_message[message['message_id']] = index
+    for timestamp, method, data in events:
+        if method == 'sendMediaGroup':
+            for file_id in data['file_ids']:
+                sent_at.setdefault(file_id, timestamp)
+        elif data.get('reply_to') in item_by_message:
+            replied_at.setdefault(item_by_message[data['reply_to']], timestamp)
+
+    latencies = []
+    for index, (_, messages) in enumerate(workload.schedule):
+        done_times = []
+        for message in messages:
+            media = message.get('photo', [None])[-1] or message.get('video') or message.get('document')
+            file_id = media['file_id']
+            if file_id in sent_at:
+                done_times.append(sent_at[file_id])
+            elif index in replied_at and (lenient or file_id in workload.duplicate_file_ids):
+                done_times.append(replied_at[index])
+            else:
+                done_times.append(None)
+        if None in done_times:
+            latencies.append(None)
+        else:
+            latencies.append(max(done_times) - inject_times[index])
+    return latencies
+
+
+def run_workload(name, args):
+    """Прогоняет одну нагрузку и возвращает отчет"""
+    workload = WORKLOADS[name](args.scale, args.seed)
+    server_config = {
+        'api_latency': args.api_latency,
+        'download_latency': args.download_latency,
+        'bandwidth': args.bandwidth,
+        'send_rate_per_minute': args.server_send_rate,
+        'error_429_rate': args.error_429_rate,
+    }
+    parent_connection, child_connection = multiprocessing.Pipe()
+    server_process = multiprocessing.get_context('spawn').Process(
+        target=fake_bot_api.serve_in_process, args=(child_connection, server_config), daemon=True)
+    server_process.start()
+    api_url = f'http://127.0.0.1:{parent_connection.recv()}'
+    control_request(api_url, 'files', workload.files)
+
+    settings = dict(BOT_SETTINGS)
+    settings.update(parse_setting(text) for text in args.set)
+    workdir = tempfile.mkdtemp(prefix='tgbot-benchmark-')
+    Bot = start_bot(api_url, args.ingest, settings, workdir, args.log_level)
+
+    update_ids = iter(range(1, 1 << 62))
+    inject_times = []
+    started = time.time()
+    for offset, messages in workload.schedule:
+        delay = started + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        inject_times.append(time.time())
+        inject_messages(Bot, api_url, args.ingest, messages, update_ids)
+
+    # Ждем, пока все элементы не будут обработаны или бот не перестанет отправлять
+    last_event_count = -1
+    last_change = time.time()
+    while True:
+        events = control_request(api_url, 'events')
+        if None not in resolve_items(workload, inject_times, events, lenient=False):
+            break
+        if len(events) != last_event_count:
+            last_event_count = len(events)
+            last_change = time.time()
+        elif time.time() - last_change > SETTLE_SECONDS or time.time() - started > args.timeout:
+            break
+        time.sleep(EVENTS_POLL_INTERVAL)
+
+    latencies = resolve_items(workload, inject_times, events, lenient=True)
+    completed = [latency for latency in latencies if latency is not None]
+    finished = max([timestamp for timestamp, _, _ in events] or [time.time()])
+    duration = max(finished - inject_times[0], 1e-9)
+    server_stats = control_request(api_url, 'stats')
+
+    stages = {}
+    with Bot.metrics.lock:
+        for (metric, labels), histogram in Bot.metrics.histograms.items():
+            if metric == 'tgbot_stage_duration_seconds':
+                stages[dict(labels)['stage']] = {'count': histogram[-1],
+                                                  'mean_ms': round(histogram[-2] / histogram[-1] * 1000, 2)}
+
+    Bot.close_database()
+    Bot.stop_logging()
+    parent_connection.send('stop')
+    server_process.join(5)
+
+    database_size = sum(os.path.getsize(os.path.join(workdir, file_name)) for file_name in os.listdir(workdir)
+                        if file_name.startswith('media_deduplication.db'))
+    message_count = sum(len(messages) for _, messages in workload.schedule)
+    return {
+        'workload': name,
+        'ingest': args.ingest,
+        'items': len(workload.schedule),
+        'messages': message_count,
+        'completed_items': len(completed),
+        'duration_s': round(duration, 3),
+        'throughput_msg_s': round(message_count / duration, 2),
+        'latency_p50_ms': round(percentile(completed, 0.5) * 1000, 1) if completed else None,
+        'latency_p99_ms': round(percentile(completed, 0.99) * 1000, 1) if completed else None,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'database_bytes': database_size,
+        'server': server_stats,
+        'stages': stages,
+    }
+
+
+def run_in_subprocess(name, argv):
+    """Запускает нагрузку в отдельном процессе, чтобы пиковый RSS и состояние бота не смешивались"""
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as output:
+        output_path = output.name
+    try:
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--workload', name, '--json', output_path] + argv,
+                       check=True)
+        with open(output_path) as f:
+            return json.load(f)[name]
+    finally:
+        os.unlink(output_path)
+
+
+def format_report(report):
+    lines = [f"== {report['workload']} (прием: {report['ingest']})",
+             f"  сообщений: {report['messages']}, элементов: {report['items']}, "
+             f"обработано: {report['completed_items']}",
+             f"  пропускная способность: {report['throughput_msg_s']} сообщ/с за {report['duration_s']} с",
+             f"  задержка p50: {report['latency_p50_ms']} мс, p99: {report['latency_p99_ms']} мс",
+             f"  пиковый RSS: {report['peak_rss_mb']} МБ, размер БД: {report['database_bytes'] / 1024:.1f} КБ",
+             f"  сервер: {json.dumps(report['server'], sort_keys=True)}"]
+    for stage, values in sorted(report['stages'].items()):
+        lines.append(f"  стадия {stage}: {values['count']} раз, в среднем {values['mean_ms']} мс")
+    return '\n'.join(lines)
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Возвращает список ухудшений относительно сохраненных результатов"""
+    regressions = []
+    for name, report in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if report['completed_items'] < base['completed_items']:
+            regressions.append(f"{name}: обработано {report['completed_items']} элементов, было {base['completed_items']}")
+        if report['throughput_msg_s'] < base['throughput_msg_s'] * (1 - tolerance):
+            regressions.append(f"{name}: пропускная способность {report['throughput_msg_s']}, было {base['throughput_msg_s']}")
+        for key in ('latency_p99_ms', 'peak_rss_mb', 'database_bytes'):
+            if report[key] is not None and base.get(key) and report[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{name}: {key} {report[key]}, было {base[key]}")
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальной замене Bot API")
+    parser.add_argument('--workload', nargs='+', choices=sorted(WORKLOADS), default=sorted(WORKLOADS),
+                        help="Нагрузки для прогона (по умолчанию все)")
+    parser.add_argument('--ingest', choices=['queue', 'polling', 'webhook'], default='queue',
+                        help="Способ доставки обновлений боту")
+    parser.add_argument('--scale', type=float, default=1.0, help="Множитель объема нагрузки")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--api-latency', type=float, default=0.05, help="Задержка ответа Bot API, с")
+    parser.add_argument('--download-latency', type=float, default=0.05, help="Задержка до первого байта файла, с")
+    parser.add_argument('--bandwidth', type=float, help="Скорость отдачи файла одному соединению, байт/с")
+    parser.add_argument('--server-send-rate', type=int, help="Отправок в минуту в чат, после которых сервер отвечает 429")
+    parser.add_argument('--error-429-rate', type=float, default=0.0, help="Доля отправок со случайным ответом 429")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help="Переопределить настройку модуля бота (например SINGLE_MEDIA_BATCH_WINDOW=2.0)")
+    parser.add_argument('--timeout', type=float, default=600, help="Максимальная длительность прогона, с")
+    parser.add_argument('--log-level', default='WARNING', help="Уровень журнала бота")
+    parser.add_argument('--json', help="Сохранить результаты в JSON")
+    parser.add_argument('--baseline', help="JSON с прошлыми результатами для сравнения")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Допустимое ухудшение относительно baseline")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    results = {}
+    if len(args.workload) == 1:
+        results[args.workload[0]] = run_workload(args.workload[0], args)
+    else:
+        # Параметры, кроме списка нагрузок и файлов результатов, передаются каждому прогону
+        argv = []
+        skip = False
+        for arg in sys.argv[1:]:
+            if skip and not arg.startswith('--'):
+                continue
+            skip = arg in ('--workload', '--json', '--baseline')
+            if not skip:
+                argv.append(arg)
+        for name in args.workload:
+            results[name] = run_in_subprocess(name, argv)
+
+    for report in results.values():
+        print(format_report(report))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Ухудшение: {regression}")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,119 @@
+"""
+Сетевое хранилище дедупликации для нескольких экземпляров бота
+
+Экземпляры бота на разных машинах (или процессах) подключаются к серверу через
+Bot.RemoteDedupStore (параметр --dedup-url бота) и делят одну базу медиа и резервы
+ключей, поэтому одно и то же медиа не отправляется дважды. Данные хранятся
+в файле SQLite (Bot.SQLiteDedupStore), сервер подходит и как локальная замена
+для проверки сетевого режима.
+
+Каждый метод хранилища - POST /<метод> с JSON-объектом аргументов,
+ответ {"ok": true, "result": ...}; байтовые значения передаются в hex.
+
+Пример:
+    python dedup_server.py --listen 0.0.0.0:8090 --database media_deduplication.db
+    python Bot.py --dedup-url http://dedup-host:8090 --workers 4
+"""
+
+import argparse
+import json
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import Bot
+
+logger = logging.getLogger('tgbot.dedup_server')
+
+
+def call_store(store, method, payload):
+    """Вызывает метод хранилища по JSON-аргументам и возвращает JSON-совместимый результат"""
+    if method == 'ping':
+        return True
+    if method == 'find_by_unique_ids':
+        return store.find_by_unique_ids(payload['keys'])
+    if method == 'find_by_file_ids':
+        return store.find_by_file_ids(payload['keys'])
+    if method == 'find_by_hashes':
+        found = store.find_by_hashes([(bytes.fromhex(data_hash), file_size) for data_hash, file_size in payload['items']])
+        return [[data_hash.hex(), file_size, message_id] for (data_hash, file_size), message_id in found.items()]
+    if method == 'find_by_phash':
+        return store.find_by_phash(payload['phash'])
+    if method == 'find_prefix_candidates':
+        candidates = store.find_prefix_candidates(payload['file_size'], bytes.fromhex(payload['prefix_hash']))
+        return [[file_id, message_id, data_hash.hex() if data_hash else None]
+                for file_id, message_id, data_hash in candidates]
+    if method == 'add_media':
+        store.add_media(Bot.decode_media_row(payload['row']))
+        return True
+    if method == 'try_claim':
+        return store.try_claim(payload['keys'], payload['owner'], payload['ttl'])
+    if method == 'release':
+        store.release(payload['keys'], payload['owner'])
+        return True
+    raise KeyError(method)
+
+
+class DedupServerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Заголовки и тело ответа пишутся отдельно, без TCP_NODELAY каждый запрос ждал бы задержанного ACK
+    disable_nagle_algorithm = True
+    store = None  # Bot.DedupStore, задается при запуске сервера
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        method = self.path.strip('/')
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+            result = call_store(self.store, method, payload)
+        except KeyError:
+            self.send_json({'ok': False, 'description': f"Неизвестный метод или аргумент: {method}"}, 400)
+            return
+        except Exception as e:
+            logger.error("Ошибка метода %s: %s", method, e)
+            self.send_json({'ok': False, 'description': str(e)}, 500)
+            return
+        self.send_json({'ok': True, 'result': result})
+
+
+def start_server(host='127.0.0.1', port=0, store=None):
+    """Запускает сервер в фоновом потоке над открытым хранилищем, возвращает сервер"""
+    handler = type('BoundDedupServerHandler', (DedupServerHandler,), {'store': store})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="dedup-server", daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Сетевое хранилище дедупликации медиа")
+    parser.add_argument('--listen', default='127.0.0.1:8090', help="Адрес сервера")
+    parser.add_argument('--database', default=Bot.DATABASE_PATH, help="Путь к базе дедупликации")
+    parser.add_argument('--log-level', default='INFO', help="Уровень журнала (DEBUG, INFO, WARNING, ERROR)")
+    args = parser.parse_args()
+
+    Bot.setup_logging(args.log_level.upper())
+    Bot.DATABASE_PATH = args.database
+    store = Bot.SQLiteDedupStore(claims=True)
+    store.open()
+    host, _, port = args.listen.rpartition(':')
+    server = start_server(host or '127.0.0.1', int(port), store)
+    logger.info("Хранилище дедупликации доступно на http://%s:%s", host, server.server_port)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+    finally:
+        store.close()
+        Bot.stop_logging()
@@ -0,0 +1,429 @@
+"""
+Локальная замена сервера Bot API для нагрузочного тестирования бота
+
+Поддерживает getUpdates (long polling), setWebhook/deleteWebhook с доставкой обновлений
+на вебхук бота, getFile, скачивание файлов (в том числе запросы Range), sendMediaGroup
+и sendMessage. Задержка ответов, пропускная способность загрузок и ответы 429
+настраиваются. Содержимое файлов не хранится, а генерируется детерминированно
+по ключу содержимого, поэтому одинаковые ключи дают одинаковые байты (дубликаты).
+
+Управление идет через служебные адреса /control/...:
+    POST /control/files    - зарегистрировать файлы {file_id: {"content": ключ, "size": байт, "kind": тип}}
+    POST /control/updates  - поставить обновления в очередь getUpdates или отправить на вебхук
+    POST /control/config   - изменить настройки (ключи как у FakeApiConfig)
+    GET  /control/events   - отправленные ботом альбомы и сообщения с отметками времени
+    GET  /control/stats    - счетчики запросов
+"""
+
+import argparse
+import io
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+import urllib.request
+import email.parser
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # Без Pillow фотографии генерируются как случайные байты
+
+MAX_GET_FILE_SIZE = 20 * 1024 * 1024  # Файлы крупнее Bot API не отдает через getFile
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+WEBHOOK_RETRY_DELAY = 0.5  # Пауза перед повторной доставкой обновления, если вебхук ответил ошибкой
+
+
+class FakeApiConfig:
+    """Настройки поведения сервера"""
+    def __init__(self):
+        self.api_latency = 0.0  # Задержка ответа на вызов метода, в секундах
+        self.download_latency = 0.0  # Задержка до первого байта при скачивании файла, в секундах
+        self.bandwidth = None  # Скорость отдачи файла одному соединению, байт/с (None - без ограничения)
+        self.send_rate_per_minute = None  # Сколько отправок в минуту в один чат разрешено до ответа 429
+        self.error_429_rate = 0.0  # Доля отправок, на которые случайно отвечается 429
+        self.retry_after = 1  # Значение retry_after в ответах 429
+
+    def update(self, values):
+        for key, value in values.items():
+            if not hasattr(self, key):
+                raise ValueError(f"Неизвестная настройка: {key}")
+            setattr(self, key, value)
+
+
+class FakeBotApi:
+    """Состояние сервера: файлы, очередь обновлений, вебхук и журнал отправок"""
+    def __init__(self, config=None):
+        self.config = config or FakeApiConfig()
+        self.lock = threading.Lock()
+        self.files = {}  # file_id -> {"content", "size", "kind"}
+        self.photo_cache = {}  # Ключ содержимого -> байты сгенерированного изображения
+        self.updates = []
+        self.updates_available = threading.Condition(self.lock)
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.webhook_queue = []
+        self.webhook_available = threading.Condition(self.lock)
+        self.events = []  # (время, метод, данные)
+        self.message_ids = iter(range(1, 1 << 62))
+        self.send_times = defaultdict(list)  # chat_id -> время последних отправок
+        self.random = random.Random(0)
+        self.stats = defaultdict(int)
+        threading.Thread(target=self._deliver_webhooks, name="fake-api-webhook", daemon=True).start()
+
+    # ---------- Содержимое файлов ----------
+
+    def file_content(self, file_id):
+        """Генерирует содержимое файла по его ключу содержимого"""
+        description = self.files[file_id]
+        if description.get('kind') == 'photo' and Image is not None:
+            with self.lock:
+                data = self.photo_cache.get(description['content'])
+            if data is None:
+                data = generate_photo(description['content'])
+                with self.lock:
+                    self.photo_cache[description['content']] = data
+            return data
+        return random.Random(description['content']).randbytes(description['size'])
+
+    def file_size(self, file_id):
+        description = self.files[file_id]
+        if description.get('kind') == 'photo' and Image is not None:
+            return len(self.file_content(file_id))
+        return description['size']
+
+    # ---------- Обновления ----------
+
+    def add_updates(self, updates):
+        """Ставит обновления в очередь getUpdates или на доставку вебхуку"""
+        with self.lock:
+            if self.webhook_url:
+                self.webhook_queue.extend(updates)
+                self.webhook_available.notify_all()
+            else:
+                self.updates.extend(updates)
+                self.updates_available.notify_all()
+
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            # Обновления с update_id меньше offset подтверждены ботом
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.updates_available.wait(deadline - time.monotonic())
+            return list(self.updates[:100])
+
+    def set_webhook(self, url, secret_token=None):
+        """Включает или (при пустом url) выключает вебхук, недоставленные обновления переходят к новому получателю"""
+        with self.lock:
+            self.webhook_url = url or None
+            self.webhook_secret = secret_token
+            if self.webhook_url:
+                self.webhook_queue.extend(self.updates)
+                self.updates = []
+                self.webhook_available.notify_all()
+            else:
+                self.updates.extend(self.webhook_queue)
+                self.webhook_queue = []
+                self.updates_available.notify_all()
+
+    def _deliver_webhooks(self):
+        """Доставляет обновления на вебхук бота по одному, повторяя при ошибках (как Telegram)"""
+        while True:
+            with self.lock:
+                while not self.webhook_queue or not self.webhook_url:
+                    self.webhook_available.wait()
+                update = self.webhook_queue[0]
+                url, secret = self.webhook_url, self.webhook_secret
+            request = urllib.request.Request(url, data=json.dumps(update).encode(), method='POST',
+                                             headers={'Content-Type': 'application/json'})
+            if secret:
+                request.add_header('X-Telegram-Bot-Api-Secret-Token', secret)
+            try:
+                with urllib.request.urlopen(request, timeout=30):
+                    pass
+            except Exception:
+                self.stats['webhook_retries'] += 1
+                time.sleep(WEBHOOK_RETRY_DELAY)
+                continue
+            with self.lock:
+                self.webhook_queue.pop(0)
+
+    # ---------- Отправка ----------
+
+    def check_send_rate(self, chat_id):
+        """Возвращает True, если отправку нужно отклонить ответом 429"""
+        config = self.config
+        with self.lock:
+            if config.error_429_rate and self.random.random() < config.error_429_rate:
+                return True
+            if config.send_rate_per_minute:
+                now = time.monotonic()
+                times = [t for t in self.send_times[chat_id] if now - t < 60]
+                self.send_times[chat_id] = times
+                if len(times) >= config.send_rate_per_minute:
+                    return True
+                times.append(now)
+        return False
+
+    def record_event(self, method, data):
+        with self.lock:
+            self.events.append((time.time(), method, data))
+
+    def new_message(self, chat_id):
+        with self.lock:
+            message_id = next(self.message_ids)
+        return {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': int(chat_id), 'type': 'supergroup'}}
+
+
+def generate_photo(content_key):
+    """Генерирует JPEG из шума, одинаковый для одинакового ключа"""
+    noise = random.Random(content_key).randbytes(32 * 24)
+    image = Image.frombytes('L', (32, 24), noise).resize((640, 480))
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+
+def parse_request_params(handler, body):
+    """Разбирает параметры вызова метода: query, form, JSON или multipart"""
+    content_type = handler.headers.get('Content-Type', '')
+    params = {}
+    if 'multipart/form-data' in content_type:
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        for part in message.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            value = part.get_payload(decode=True)
+            params[name] = value if part.get_filename() else value.decode()
+    elif 'application/json' in content_type:
+        params = json.loads(body or b'{}')
+    elif body:
+        params = dict(urllib.parse.parse_qsl(body.decode()))
+    params.update(urllib.parse.parse_qsl(urllib.parse.urlparse(handler.path).query))
+    return params
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    api = None  # FakeBotApi, задается при запуске сервера
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_api_error(self, status, description, parameters=None):
+        payload = {'ok': False, 'error_code': status, 'description': description}
+        if parameters:
+            payload['parameters'] = parameters
+        self.send_json(payload, status)
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        match = re.match(r'/file/bot[^/]+/(.+)', path)
+        if match:
+            self.send_file(urllib.parse.unquote(match.group(1)))
+        elif path.startswith('/control/'):
+            self.handle_control(path, b'')
+        else:
+            self.handle_method(path, b'')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        path = urllib.parse.urlparse(self.path).path
+        if path.startswith('/control/'):
+            self.handle_control(path, body)
+        else:
+            self.handle_method(path, body)
+
+    # ---------- Служебные адреса ----------
+
+    def handle_control(self, path, body):
+        api = self.api
+        if path == '/control/files':
+            with api.lock:
+                api.files.update(json.loads(body))
+            self.send_json({'ok': True})
+        elif path == '/control/updates':
+            api.add_updates(json.loads(body))
+            self.send_json({'ok': True})
+        elif path == '/control/config':
+            api.config.update(json.loads(body))
+            self.send_json({'ok': True})
+        elif path == '/control/events':
+            with api.lock:
+                events = list(api.events)
+            self.send_json({'ok': True, 'result': events})
+        elif path == '/control/stats':
+            self.send_json({'ok': True, 'result': dict(api.stats)})
+        else:
+            self.send_error(404)
+
+    # ---------- Скачивание файлов ----------
+
+    def send_file(self, file_path):
+        api = self.api
+        file_id = file_path.rsplit('/', 1)[-1]
+        if file_id not in api.files:
+            self.send_error(404)
+            return
+        if api.config.download_latency:
+            time.sleep(api.config.download_latency)
+        data = api.file_content(file_id)
+        range_header = self.headers.get('Range')
+        if range_header:
+            start, _, end = range_header.split('=', 1)[1].partition('-')
+            start = int(start)
+            end = min(int(end), len(data) - 1) if end else len(data) - 1
+            part = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{start + len(part) - 1}/{len(data)}')
+            api.stats['range_downloads'] += 1
+        else:
+            part = data
+            self.send_response(200)
+            api.stats['downloads'] += 1
+        api.stats['download_bytes'] += len(part)
+        self.send_header('Content-Length', str(len(part)))
+        self.end_headers()
+        self.write_throttled(part)
+
+    def write_throttled(self, data):
+        """Отдает данные кусками, выдерживая настроенную пропускную способность"""
+        bandwidth = self.api.config.bandwidth
+        started = time.monotonic()
+        sent = 0
+        view = memoryview(data)
+        try:
+            while sent < len(data):
+                chunk = view[sent:sent + DOWNLOAD_CHUNK_SIZE]
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if bandwidth:
+                    delay = sent / bandwidth - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            # Бот закрыл соединение, получив нужное ему начало файла
+            self.close_connection = True
+
+    # ---------- Методы Bot API ----------
+
+    def handle_method(self, path, body):
+        api = self.api
+        match = re.match(r'/bot[^/]+/(\w+)', path)
+        if not match:
+            self.send_error(404)
+            return
+        method = match.group(1)
+        params = parse_request_params(self, body)
+        api.stats[f'method_{method}'] += 1
+        if api.config.api_latency and method != 'getUpdates':
+            time.sleep(api.config.api_latency)
+
+        if method == 'getMe':
+            self.send_json({'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'fake', 'username': 'fake_bot'}})
+        elif method == 'getUpdates':
+            updates = api.get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+            self.send_json({'ok': True, 'result': updates})
+        elif method in ('setWebhook', 'deleteWebhook'):
+            # setWebhook с пустым url удаляет вебхук, как и deleteWebhook
+            api.set_webhook(params.get('url') if method == 'setWebhook' else None, params.get('secret_token'))
+            self.send_json({'ok': True, 'result': True})
+        elif method == 'getFile':
+            self.get_file(params.get('file_id'))
+        elif method in ('sendMediaGroup', 'sendMessage'):
+            self.send_message(method, params)
+        else:
+            self.send_json({'ok': True, 'result': True})
+
+    def get_file(self, file_id):
+        api = self.api
+        if file_id not in api.files:
+            self.send_api_error(400, 'Bad Request: invalid file_id')
+            return
+        file_size = api.file_size(file_id)
+        if file_size > MAX_GET_FILE_SIZE:
+            self.send_api_error(400, 'Bad Request: file is too big')
+            return
+        self.send_json({'ok': True, 'result': {'file_id': file_id, 'file_unique_id': f'u{file_id}',
+                                                'file_size': file_size, 'file_path': f'files/{file_id}'}})
+
+    def send_message(self, method, params):
+        api = self.api
+        chat_id = params.get('chat_id')
+        if api.check_send_rate(chat_id):
+            api.stats['responses_429'] += 1
+            self.send_api_error(429, f'Too Many Requests: retry after {api.config.retry_after}',
+                                {'retry_after': api.config.retry_after})
+            return
+
+        if method == 'sendMessage':
+            reply_to = params.get('reply_to_message_id')
+            if params.get('reply_parameters'):
+                reply_to = json.loads(params['reply_parameters']).get('message_id')
+            api.record_event('sendMessage', {'reply_to': int(reply_to) if reply_to else None})
+            self.send_json({'ok': True, 'result': api.new_message(chat_id)})
+            return
+
+        media = json.loads(params['media'])
+        file_ids = [item['media'] for item in media]
+        uploads = sum(1 for item in media if item['media'].startswith('attach://'))
+        api.stats['uploads'] += uploads
+        api.record_event('sendMediaGroup', {'file_ids': file_ids})
+        self.send_json({'ok': True, 'result': [api.new_message(chat_id) for _ in media]})
+
+
+def start_server(host='127.0.0.1', port=0, config=None):
+    """Запускает сервер в фоновом потоке, возвращает (сервер, FakeBotApi)"""
+    api = FakeBotApi(config)
+    handler = type('BoundFakeBotApiHandler', (FakeBotApiHandler,), {'api': api})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-api-server", daemon=True).start()
+    return server, api
+
+
+def serve_in_process(connection, config_values):
+    """Точка входа для запуска сервера в отдельном процессе: порт передается через connection"""
+    config = FakeApiConfig()
+    config.update(config_values)
+    server, _ = start_server(config=config)
+    connection.send(server.server_port)
+    connection.recv()  # Ждем команды на остановку
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Локальная замена сервера Bot API")
+    parser.add_argument('--listen', default='127.0.0.1:8081', help="Адрес сервера")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="Задержка ответа на вызов метода, с")
+    parser.add_argument('--download-latency', type=float, default=0.0, help="Задержка до первого байта файла, с")
+    parser.add_argument('--bandwidth', type=float, help="Скорость отдачи файла одному соединению, байт/с")
+    parser.add_argument('--send-rate', type=int, help="Отправок в минуту в один чат до ответа 429")
+    parser.add_argument('--error-429-rate', type=float, default=0.0, help="Доля отправок со случайным ответом 429")
+    args = parser.parse_args()
+
+    config = FakeApiConfig()
+    config.update({'api_latency': args.api_latency, 'download_latency': args.download_latency,
+                   'bandwidth': args.bandwidth, 'send_rate_per_minute': args.send_rate,
+                   'error_429_rate': args.error_429_rate})
+    host, _, port = args.listen.rpartition(':')
+    server, _ = start_server(host or '127.0.0.1', int(port), config)
+    print(f"Сервер Bot API запущен на http://{host}:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()